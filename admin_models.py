@@ -3,6 +3,7 @@ from sqladmin import ModelView
 from sqladmin.authentication import AuthenticationBackend
 
 import database
+import history
 import models
 from services import create_token, authenticate_user
 
@@ -12,16 +13,16 @@ class AdminAuth(AuthenticationBackend):
     async def login(self, request: Request) -> bool:
         form = await request.form()
         username, password = form["username"], form["password"]
-        db = database.SessionLocal()
-        try:
-            user = await authenticate_user(username, password, db)
-            token = await create_token(user)
-            if user.role == 'admin':
-                request.session.update({"token": token})
-            else:
+        async with database.AsyncSessionLocal() as db:
+            try:
+                user = await authenticate_user(username, password, db)
+                token = await create_token(user)
+                if user.role == 'admin':
+                    request.session.update({"token": token})
+                else:
+                    return False
+            except Exception:
                 return False
-        except Exception:
-            return False
         return True
 
     async def logout(self, request: Request) -> bool:
@@ -37,6 +38,16 @@ class AdminAuth(AuthenticationBackend):
         return True
 
 
+class ChangeLogView(ModelView):
+    async def get_object_for_details(self, value):
+        record = await super().get_object_for_details(value)
+        if record is None or record.checkpoint:
+            return record
+        for key, column_value in history.reconstruct(await self._run_query(history.chain_statement(record))).items():
+            setattr(record, key, column_value)
+        return record
+
+
 class UserAdmin(ModelView, model=models.User):
     column_list = [models.User.username, models.User.role]
     column_searchable_list = [models.User.username]
@@ -84,27 +95,27 @@ class PaymentCheckAdmin(ModelView, model=models.PaymentCheck):
     column_list = [models.PaymentCheck.username_id, models.PaymentCheck.value]
 
 
-class PaymentHistoryAdmin(ModelView, model=models.PaymentCheckHistory):
+class PaymentHistoryAdmin(ChangeLogView, model=models.PaymentCheckHistory):
     column_list = [models.PaymentCheckHistory.payment_id]
 
 
-class UserHistoryAdmin(ModelView, model=models.UserHistory):
+class UserHistoryAdmin(ChangeLogView, model=models.UserHistory):
     column_list = [models.UserHistory.user_id]
 
 
-class ReferralHistoryAdmin(ModelView, model=models.ReferralCodeHistory):
+class ReferralHistoryAdmin(ChangeLogView, model=models.ReferralCodeHistory):
     column_list = [models.ReferralCodeHistory.referral_code_id]
 
 
-class JoinHistoryAdmin(ModelView, model=models.JoinCodeHistory):
+class JoinHistoryAdmin(ChangeLogView, model=models.JoinCodeHistory):
     column_list = [models.JoinCodeHistory.username_id]
 
 
-class ClientHistoryAdmin(ModelView, model=models.ClientInWorkHistory):
+class ClientHistoryAdmin(ChangeLogView, model=models.ClientInWorkHistory):
     column_list = [models.ClientInWorkHistory.client_id]
 
 
-class TicketHistoryAdmin(ModelView, model=models.TicketChatHistory):
+class TicketHistoryAdmin(ChangeLogView, model=models.TicketChatHistory):
     column_list = [models.TicketChatHistory.ticket_id]
 
 
@@ -0,0 +1,53 @@
+"""add query indexes
+
+Revision ID: 3f9c2a7d1b4e
+Revises: 
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9c2a7d1b4e'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = [
+    ('ix_user_role', 'user', ['role']),
+    ('ix_user_recruiter_id', 'user', ['recruiter_id']),
+    ('ix_user_mentor_id', 'user', ['mentor_id']),
+    ('ix_user_manager_id', 'user', ['manager_id']),
+    ('ix_referral_code_code', 'referral_code', ['code']),
+    ('ix_referral_code_username_id', 'referral_code', ['username_id']),
+    ('ix_join_code_code', 'join_code', ['code']),
+    ('ix_join_code_username_id', 'join_code', ['username_id']),
+    ('ix_client_in_work_worker_id_status', 'client_in_work', ['worker_id', 'status']),
+    ('ix_client_in_work_worker_id_deposit_date', 'client_in_work', ['worker_id', 'deposit_date']),
+    ('ix_client_in_work_manager_id', 'client_in_work', ['manager_id']),
+    ('ix_client_in_work_status', 'client_in_work', ['status']),
+    ('ix_chat_message_ticket_id_id', 'chat_message', ['ticket_id', 'id']),
+    ('ix_ticket_chat_token', 'ticket_chat', ['token']),
+    ('ix_ticket_chat_user_id_closed', 'ticket_chat', ['user_id', 'closed']),
+    ('ix_ticket_chat_mentor_id_closed', 'ticket_chat', ['mentor_id', 'closed']),
+    ('ix_payment_check_username_id_state', 'payment_check', ['username_id', 'state']),
+    ('ix_task_mentor_id', 'task', ['mentor_id']),
+    ('ix_task_category_username', 'task', ['category', 'username']),
+    ('ix_task_request_task_id_status', 'task_request', ['task_id', 'status']),
+    ('ix_task_request_user_id_task_id', 'task_request', ['user_id', 'task_id']),
+]
+
+
+def upgrade() -> None:
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+    op.execute('ANALYZE')
+
+
+def downgrade() -> None:
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,39 @@
+"""add archive_block index of archived row blocks
+
+Revision ID: 4b8f2d6e1c90
+Revises: e7d3a1c94b26
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4b8f2d6e1c90'
+down_revision: Union[str, None] = 'e7d3a1c94b26'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('archive_block',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('kind', sa.String(), nullable=False),
+                    sa.Column('key', sa.Integer(), nullable=False),
+                    sa.Column('segment', sa.String(), nullable=False),
+                    sa.Column('offset', sa.Integer(), nullable=False),
+                    sa.Column('length', sa.Integer(), nullable=False),
+                    sa.Column('row_count', sa.Integer(), nullable=False),
+                    sa.Column('first_id', sa.Integer(), nullable=True),
+                    sa.Column('last_id', sa.Integer(), nullable=True),
+                    sa.Column('created', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_archive_block_kind_key', 'archive_block', ['kind', 'key'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_archive_block_kind_key', table_name='archive_block')
+    op.drop_table('archive_block')
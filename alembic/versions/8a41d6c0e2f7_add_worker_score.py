@@ -0,0 +1,33 @@
+"""add worker_score leaderboard table
+
+Revision ID: 8a41d6c0e2f7
+Revises: 3f9c2a7d1b4e
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8a41d6c0e2f7'
+down_revision: Union[str, None] = '3f9c2a7d1b4e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('worker_score',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('closes', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('user_id'))
+    op.create_index('ix_worker_score_closes_user_id', 'worker_score', ['closes', 'user_id'])
+    op.execute("INSERT INTO worker_score (user_id, closes) "
+               "SELECT worker_id, count(*) FROM client_in_work WHERE status = 'approved' GROUP BY worker_id")
+
+
+def downgrade() -> None:
+    op.drop_index('ix_worker_score_closes_user_id', table_name='worker_score')
+    op.drop_table('worker_score')
@@ -0,0 +1,39 @@
+"""never reuse chat_message ids on sqlite
+
+Revision ID: 9d2e6b4a7f15
+Revises: 4b8f2d6e1c90
+Create Date: 2026-10-18 20:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d2e6b4a7f15'
+down_revision: Union[str, None] = '4b8f2d6e1c90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # postgres sequences never go back, sqlite reuses the highest rowid once it is deleted
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('chat_message', recreate='always', table_kwargs={'sqlite_autoincrement': True}):
+        pass
+    # messages archived before this revision may have had higher ids than anything left in the table
+    bind = op.get_bind()
+    seq = max(bind.scalar(sa.text("SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = 'chat_message'")),
+              bind.scalar(sa.text("SELECT coalesce(max(last_id), 0) FROM archive_block WHERE kind = 'chat_message'")))
+    bind.execute(sa.text("DELETE FROM sqlite_sequence WHERE name = 'chat_message'"))
+    bind.execute(sa.text("INSERT INTO sqlite_sequence (name, seq) VALUES ('chat_message', :seq)"), {'seq': seq})
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('chat_message', recreate='always', table_kwargs={'sqlite_autoincrement': False}):
+        pass
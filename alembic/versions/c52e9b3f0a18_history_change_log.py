@@ -0,0 +1,55 @@
+"""store history rows as checkpoints and column deltas
+
+Revision ID: c52e9b3f0a18
+Revises: 8a41d6c0e2f7
+Create Date: 2026-10-18 14:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c52e9b3f0a18'
+down_revision: Union[str, None] = '8a41d6c0e2f7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# history table -> column with the id of the source row
+TABLES = {
+    'user_history': 'user_id',
+    'referral_code_history': 'referral_code_id',
+    'join_code_history': None,
+    'client_in_work_history': 'client_id',
+    'ticket_chat_history': 'ticket_id',
+    'payment_check_history': 'payment_id',
+}
+
+
+def upgrade() -> None:
+    for table, id_column in TABLES.items():
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('version', sa.Integer(), nullable=True))
+            batch_op.add_column(sa.Column('checkpoint', sa.Boolean(), nullable=True))
+            batch_op.add_column(sa.Column('changed_columns', sa.String(), nullable=True))
+        # existing rows are full snapshots
+        if id_column is None:
+            op.execute(f"UPDATE {table} SET version = 1, checkpoint = true, changed_columns = ''")
+            continue
+        op.create_index(f'ix_{table}_{id_column}_version', table, [id_column, 'version'])
+        # one pass numbering every chain, a correlated count per row is quadratic on long histories
+        op.execute(f"UPDATE {table} SET checkpoint = true, changed_columns = '', version = numbered.version "
+                   f"FROM (SELECT id, row_number() OVER (PARTITION BY {id_column} ORDER BY id) AS version "
+                   f"FROM {table}) AS numbered WHERE numbered.id = {table}.id")
+
+
+def downgrade() -> None:
+    for table, id_column in TABLES.items():
+        if id_column is not None:
+            op.drop_index(f'ix_{table}_{id_column}_version', table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('changed_columns')
+            batch_op.drop_column('checkpoint')
+            batch_op.drop_column('version')
@@ -0,0 +1,41 @@
+"""index history tables for point-in-time lookups
+
+Revision ID: e7d3a1c94b26
+Revises: c52e9b3f0a18
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7d3a1c94b26'
+down_revision: Union[str, None] = 'c52e9b3f0a18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = [
+    ('ix_user_history_user_id_change_time', 'user_history', ['user_id', 'change_time']),
+    ('ix_user_history_mentor_id', 'user_history', ['mentor_id']),
+    ('ix_client_in_work_history_client_id_change_time', 'client_in_work_history', ['client_id', 'change_time']),
+    ('ix_ticket_chat_history_ticket_id_change_time', 'ticket_chat_history', ['ticket_id', 'change_time']),
+    ('ix_payment_check_history_payment_id_change_time', 'payment_check_history', ['payment_id', 'change_time']),
+]
+
+
+def upgrade() -> None:
+    # rows written before this revision have no time and are not visible to as-of queries
+    with op.batch_alter_table('payment_check_history') as batch_op:
+        batch_op.add_column(sa.Column('change_time', sa.DateTime(), nullable=True))
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade() -> None:
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+    with op.batch_alter_table('payment_check_history') as batch_op:
+        batch_op.drop_column('change_time')
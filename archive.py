@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import zlib
+
+import dotenv as _dotenv
+import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
+from sqlalchemy import orm
+
+import database as _database
+import history
+import models
+
+_dotenv.load_dotenv()
+
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+SEGMENT_MAX_BYTES = int(os.environ.get('ARCHIVE_SEGMENT_MAX_BYTES', 64 * 1024 * 1024))
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 200))
+BLOCK_ROWS = int(os.environ.get('ARCHIVE_BLOCK_ROWS', 10000))  # history tables without a source row id
+
+
+class SegmentWriter:
+    # segments are only ever appended to; a block is live once its archive_block row is committed
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        segments = sorted(name for name in os.listdir(directory) if name.startswith('segment-'))
+        self._number = int(segments[-1][8:14]) if segments else 1
+        self._file = None
+
+    def _path(self):
+        return os.path.join(self.directory, f'segment-{self._number:06d}.z')
+
+    def _open(self):
+        while os.path.exists(self._path()) and os.path.getsize(self._path()) >= SEGMENT_MAX_BYTES:
+            self._number += 1
+        self._file = open(self._path(), 'ab')
+
+    def append(self, data: bytes):
+        if self._file is None:
+            self._open()
+        elif self._file.tell() >= SEGMENT_MAX_BYTES:
+            self.sync()
+            self._file.close()
+            self._number += 1
+            self._open()
+        offset = self._file.tell()
+        self._file.write(data)
+        return os.path.basename(self._file.name), offset
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _row(obj, columns: list):
+    return {column.key: _encode(getattr(obj, column.key)) for column in columns}
+
+
+def _decode(model, row: dict):
+    values = {}
+    for column in model.__table__.columns:
+        value = row.get(column.key)
+        if value is not None and isinstance(column.type, _sql.DateTime):
+            value = datetime.datetime.fromisoformat(value)
+        values[column.key] = value
+    return model(**values)
+
+
+def _write_block(writer: SegmentWriter, kind: str, key: int, objects: list):
+    columns = list(type(objects[0]).__table__.columns)
+    data = zlib.compress(json.dumps([_row(obj, columns) for obj in objects], ensure_ascii=False).encode(), 9)
+    segment, offset = writer.append(data)
+    return models.ArchiveBlock(kind=kind, key=key, segment=segment, offset=offset, length=len(data),
+                               row_count=len(objects), first_id=objects[0].id, last_id=objects[-1].id)
+
+
+def _read_block(block: models.ArchiveBlock):
+    with open(os.path.join(ARCHIVE_DIR, block.segment), 'rb') as file:
+        file.seek(block.offset)
+        return json.loads(zlib.decompress(file.read(block.length)))
+
+
+def _read_blocks(blocks: list):
+    return [_read_block(block) for block in blocks]
+
+
+async def read_many(model, keys, db: _asyncio.AsyncSession):
+    blocks = (await db.scalars(_sql.select(models.ArchiveBlock).where(
+        models.ArchiveBlock.kind == model.__tablename__).where(models.ArchiveBlock.key.in_(keys)).order_by(
+        models.ArchiveBlock.key, models.ArchiveBlock.first_id))).all()
+    if not blocks:
+        return {}
+    archived = {}
+    for block, rows in zip(blocks, await asyncio.to_thread(_read_blocks, blocks)):
+        archived.setdefault(block.key, []).extend(_decode(model, row) for row in rows)
+    return archived
+
+
+async def read(model, key: int, db: _asyncio.AsyncSession):
+    return (await read_many(model, [key], db)).get(key, [])
+
+
+def _commit(db: orm.Session, writer: SegmentWriter, blocks: list, model, ids: list):
+    # blocks reach the disk before the index rows that point at them and the deletes are committed
+    writer.sync()
+    db.add_all(blocks)
+    for start in range(0, len(ids), 500):
+        db.execute(_sql.delete(model).where(model.id.in_(ids[start:start + 500])))
+    db.commit()
+
+
+def archive_chats(db: orm.Session, writer: SegmentWriter, cutoff: datetime.datetime):
+    last_message = _sql.func.max(models.ChatMessage.datetime)
+    tickets = db.scalars(_sql.select(models.ChatMessage.ticket_id).join(
+        models.TicketChat, models.TicketChat.id == models.ChatMessage.ticket_id).where(
+        models.TicketChat.closed == True).group_by(models.ChatMessage.ticket_id).having(last_message < cutoff)).all()
+    archived = 0
+    for start in range(0, len(tickets), BATCH_SIZE):
+        messages = db.scalars(_sql.select(models.ChatMessage).where(
+            models.ChatMessage.ticket_id.in_(tickets[start:start + BATCH_SIZE])).order_by(
+            models.ChatMessage.ticket_id, models.ChatMessage.id)).all()
+        blocks = [_write_block(writer, 'chat_message', ticket_id, list(rows))
+                  for ticket_id, rows in itertools.groupby(messages, key=lambda message: message.ticket_id)]
+        _commit(db, writer, blocks, models.ChatMessage, [message.id for message in messages])
+        archived += len(messages)
+    return archived
+
+
+def archive_history(db: orm.Session, writer: SegmentWriter, history_model, cutoff: datetime.datetime):
+    id_column = history.entity_column(history_model)
+    archived = 0
+    if id_column is None:
+        # no chains to keep together, old rows go out in blocks of BLOCK_ROWS
+        while True:
+            rows = db.scalars(_sql.select(history_model).where(history_model.change_time < cutoff).order_by(
+                history_model.id).limit(BLOCK_ROWS)).all()
+            if not rows:
+                return archived
+            _commit(db, writer, [_write_block(writer, history_model.__tablename__, 0, rows)], history_model,
+                    [row.id for row in rows])
+            archived += len(rows)
+    # only whole prefixes before a checkpoint are moved, so the hot part of every chain still starts with one
+    boundary = _sql.select(id_column.label('entity_id'), _sql.func.max(history_model.version).label('version')).where(
+        history_model.checkpoint == True).where(history_model.change_time < cutoff).where(
+        history_model.version > 1).group_by(id_column)
+    boundaries = boundary.subquery()
+    entity_ids = db.scalars(_sql.select(boundaries.c.entity_id).order_by(boundaries.c.entity_id)).all()
+    for start in range(0, len(entity_ids), BATCH_SIZE):
+        batch = boundary.where(id_column.in_(entity_ids[start:start + BATCH_SIZE])).subquery()
+        rows = db.scalars(_sql.select(history_model).join(batch, batch.c.entity_id == id_column).where(
+            history_model.version < batch.c.version).order_by(id_column, history_model.version)).all()
+        blocks = [_write_block(writer, history_model.__tablename__, entity_id, list(chain)) for entity_id, chain in
+                  itertools.groupby(rows, key=lambda row: getattr(row, id_column.key))]
+        _commit(db, writer, blocks, history_model, [row.id for row in rows])
+        archived += len(rows)
+    return archived
+
+
+def run(days: int, chats: bool = True, history_rows: bool = True):
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    writer = SegmentWriter(ARCHIVE_DIR)
+    report = {}
+    try:
+        with _database.SessionLocal() as db:
+            if chats:
+                report['chat_message'] = archive_chats(db, writer, cutoff)
+            if history_rows:
+                for history_model, _ in history.TRACKED.values():
+                    report[history_model.__tablename__] = archive_history(db, writer, history_model, cutoff)
+    finally:
+        writer.close()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move closed ticket chats and old history rows to the archive')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help='archive data older than this')
+    parser.add_argument('--chats-only', action='store_true')
+    parser.add_argument('--history-only', action='store_true')
+    args = parser.parse_args()
+    for kind, count in run(args.days, chats=not args.history_only, history_rows=not args.chats_only).items():
+        print(f'{kind}: {count}')
@@ -0,0 +1,66 @@
+import collections
+import os
+import threading
+import time
+
+import dotenv as _dotenv
+
+_dotenv.load_dotenv()
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# user id -> schemas.User
+identity_cache = TTLCache(maxsize=int(os.environ.get('IDENTITY_CACHE_SIZE', 10000)),
+                          ttl=float(os.environ.get('IDENTITY_CACHE_TTL', 60)))
+
+# trust the signed token claims instead of loading the user on read-only endpoints
+TRUST_TOKEN_CLAIMS = os.environ.get('AUTH_TRUST_TOKEN_CLAIMS', 'false').lower() in ('1', 'true', 'yes')
+
+# user id -> ((role, username, generations), mission feed); bumping a role's generation drops every feed built on it
+feed_cache = TTLCache(maxsize=int(os.environ.get('FEED_CACHE_SIZE', 10000)),
+                      ttl=float(os.environ.get('FEED_CACHE_TTL', 30)))
+feed_generation = collections.Counter()
+
+# chat token -> TicketAuth; close_ticket drops the entry here and, through the message bus, in other processes.
+# With the default local:// bus other processes never hear of it, so several workers need a shared CHAT_BUS_URL;
+# the short ttl bounds how long a missed close is believed, and messages check closed again when they are stored
+TicketAuth = collections.namedtuple('TicketAuth', ['ticket_id', 'user_id', 'mentor_id', 'closed'])
+ticket_cache = TTLCache(maxsize=int(os.environ.get('TICKET_CACHE_SIZE', 50000)),
+                        ttl=float(os.environ.get('TICKET_CACHE_TTL', 30)))
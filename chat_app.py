@@ -1,34 +1,152 @@
 import asyncio
-import datetime
+import heapq
+import itertools
+import os
 import secrets
 import string
-import threading
 import time
 
+import dotenv as _dotenv
 import fastapi
-import sqlalchemy.orm as _orm
+import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
 from fastapi import FastAPI, WebSocket, HTTPException, status, WebSocketException, WebSocketDisconnect
+from fastapi.websockets import WebSocketState
 
+import database as _database
+import message_bus
 import models
+import pagination
 import schemas
 import services
+import write_queue
+from cache import ticket_cache, TicketAuth
 from services import send_chat_message
 
+_dotenv.load_dotenv()
+
+CHANNEL_IDLE_TIMEOUT = float(os.environ.get('CHAT_CHANNEL_IDLE_TIMEOUT', 3600))
+CHAT_TOPIC = 'chat'
+
 app = FastAPI()
 
+# chat token -> Channel
 data = {}
 
 
-def cleanup_thread():
-    print("Cleanup thread started")
-    while True:
-        try:
-            time.sleep(300)
-            for channel in data:
-                if datetime.datetime.now() - data[channel]["lastactive"] > datetime.timedelta(hours=1):
-                    del data[channel]
-        except Exception as e:
-            print("ERROR (A01):", e)
+class Participant:
+    __slots__ = ('user_id', 'socket', 'lastactive', 'peer')
+
+    def __init__(self, user_id: int, now: float):
+        self.user_id = user_id
+        self.socket = None
+        self.lastactive = now
+        self.peer = None
+
+
+class Channel:
+    # a ticket chat always has exactly two participants, the worker and the mentor, linked to each other
+    __slots__ = ('token', 'ticket_id', 'user', 'mentor', 'lastactive')
+
+    def __init__(self, token: str, ticket_id: int, user_id: int, mentor_id: int):
+        now = time.monotonic()
+        self.token = token
+        self.ticket_id = ticket_id
+        self.user = Participant(user_id, now)
+        self.mentor = Participant(mentor_id, now)
+        self.user.peer = self.mentor
+        self.mentor.peer = self.user
+        self.lastactive = now
+
+    def participant(self, user_id: int):
+        if user_id == self.user.user_id:
+            return self.user
+        if user_id == self.mentor.user_id:
+            return self.mentor
+        return None
+
+    def connected(self):
+        return self.user.socket is not None or self.mentor.socket is not None
+
+    def touch(self, participant: Participant):
+        self.lastactive = participant.lastactive = time.monotonic()
+
+
+class ExpiryScheduler:
+    # one heap of deadlines for idle channels; an entry whose channel was active since it was pushed is not
+    # updated in place, it is pushed again with the new deadline when it comes up. Dead sockets are not looked
+    # for here: uvicorn pings every connection (--ws-ping-interval/--ws-ping-timeout) and ends its handler
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self.evicted_channels = 0
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def schedule(self, when: float, channel: Channel):
+        self._start()
+        if not self._heap or when < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (when, next(self._sequence), channel))
+
+    def watch_channel(self, channel: Channel):
+        self.schedule(time.monotonic() + CHANNEL_IDLE_TIMEOUT, channel)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, channel = heapq.heappop(self._heap)
+            try:
+                self._expire_channel(channel)
+            except Exception as e:
+                print("ERROR (A01):", e)
+
+    def _expire_channel(self, channel: Channel):
+        if data.get(channel.token) is not channel:
+            return
+        now = time.monotonic()
+        if channel.connected():
+            # an open socket keeps the channel however quiet it is
+            self.schedule(now + CHANNEL_IDLE_TIMEOUT, channel)
+        elif now - channel.lastactive < CHANNEL_IDLE_TIMEOUT:
+            self.schedule(channel.lastactive + CHANNEL_IDLE_TIMEOUT, channel)
+        else:
+            del data[channel.token]
+            self.evicted_channels += 1
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+    def stats(self):
+        sockets = sum((channel.user.socket is not None) + (channel.mentor.socket is not None)
+                      for channel in data.values())
+        return {'live_channels': len(data), 'live_sockets': sockets, 'evicted_channels': self.evicted_channels,
+                'scheduled': len(self._heap)}
+
+
+expiry = ExpiryScheduler()
+
+
+def open_channel(chat_token: str, ticket_id: int, user_id: int, mentor_id: int):
+    channel = data.get(chat_token)
+    if channel is None:
+        channel = data[chat_token] = Channel(chat_token, ticket_id, user_id, mentor_id)
+        expiry.watch_channel(channel)
+    return channel
 
 
 async def generate_unique_string(length):
@@ -37,102 +155,155 @@ async def generate_unique_string(length):
     return unique_string
 
 
-async def new_chat_token(user_id: int, mentor_id: int, db: _orm.Session):
+async def new_chat_token(user_id: int, mentor_id: int, db: _asyncio.AsyncSession):
     token = await generate_unique_string(8)
     ticket = models.TicketChat(token=token, user_id=user_id, mentor_id=mentor_id)
     db.add(ticket)
-    db.commit()
-    db.refresh(ticket)
+    await db.commit()
+    await db.refresh(ticket)
+    ticket_cache.set(token, TicketAuth(ticket.id, user_id, mentor_id, False))
     return token
 
 
-async def validate_token(user_id, chat_token, db: _orm.Session):
-    ticket_1 = db.query(models.TicketChat).filter(models.TicketChat.user_id == user_id).filter(
-        models.TicketChat.token == chat_token).first()
-    ticket_2 = db.query(models.TicketChat).filter(models.TicketChat.mentor_id == user_id).filter(
-        models.TicketChat.token == chat_token).first()
-    try:
-        return (ticket_1 is not None) or (ticket_2 is not None)
-    except KeyError:
-        return False
+async def deliver(message: dict):
+    # called for every chat message published on the bus, by this process or another one
+    channel = data.get(message['chat_token'])
+    if channel is None:
+        return
+    payload = {key: value for key, value in message.items() if key != 'chat_token'}
+    for participant in (channel.user, channel.mentor):
+        websocket = participant.socket
+        if websocket is None:
+            continue
+        try:
+            await websocket.send_json(payload)
+        except Exception:
+            # the client went away and its handler has not noticed yet; the peer still gets the message
+            if participant.socket is websocket:
+                participant.socket = None
 
 
-async def chat_available(chat_token, db: _orm.Session):
-    chat = db.query(models.TicketChat).filter(models.TicketChat.token == chat_token).first()
-    return chat is not None
+async def ticket_closed(message: dict):
+    # the cached ticket is gone already in the process that closed it, this covers the other ones
+    ticket_cache.invalidate(message['chat_token'])
+    channel = data.pop(message['chat_token'], None)
+    if channel is None:
+        return
+    for participant in (channel.user, channel.mentor):
+        if participant.socket is not None:
+            websocket, participant.socket = participant.socket, None
+            try:
+                await websocket.close(1000, "Ticket closed")
+            except Exception:
+                pass
 
 
-async def send_message(chat_token, user_id, user2_id, data_to_send, db: _orm.Session):
-    for user in [user_id, user2_id]:
-        try:
-            if "socket" in data[chat_token]["users"][str(user)]:
-                await data[chat_token]["users"][str(user)]["socket"].send_json(
-                    {'message_text': data_to_send, 'user_id': user_id, 'datetime': str(datetime.datetime.now())})
-        except KeyError:
-            pass
-    chat = db.query(models.TicketChat).filter(models.TicketChat.token == chat_token).first()
-    await send_chat_message(chat.id, data_to_send, user_id, db)
+def message_payload(message: models.ChatMessage):
+    return {'id': message.id, 'message_text': message.message_text, 'user_id': str(message.user_id),
+            'datetime': str(message.datetime)}
+
+
+async def send_message(channel: Channel, sender: Participant, data_to_send, db: _asyncio.AsyncSession):
+    channel.touch(sender)
+    # stored first, so that the id clients remember as last seen is known when the message goes out
+    try:
+        message = await send_chat_message(channel.ticket_id, data_to_send, sender.user_id, db)
+    except HTTPException:
+        # closed by a process whose notice did not reach this one
+        await ticket_closed({'chat_token': channel.token})
+        return
+    await message_bus.bus.publish(CHAT_TOPIC, {'chat_token': channel.token, **message_payload(message)})
+
+
+async def send_missed(websocket: WebSocket, ticket_id: int, last_seen_id: int):
+    # the socket is registered before this runs, so a live message can arrive in between or twice; clients
+    # skip ids they already have. A connection is only held while a page is read, not while a slow client
+    # is sent it
+    page = pagination.Page(last_seen_id, pagination.MAX_PAGE_SIZE)
+    while True:
+        async with _database.AsyncSessionLocal() as db:
+            chat = await services.get_ticket_chat(ticket_id, page, db)
+        for message in chat['items']:
+            await websocket.send_json(message_payload(message))
+        if not chat['has_more']:
+            return
+        page = pagination.Page(chat['items'][-1].id, page.limit)
 
 
 @app.websocket("/ws/chat")
-async def socket_handler(user_id: str, chat_token: str, websocket: WebSocket,
-                         db: _orm.Session = fastapi.Depends(services.get_db)):
+async def socket_handler(user_id: int, chat_token: str, websocket: WebSocket, last_seen_id: int = None,
+                         db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     await websocket.accept()
-    if not await chat_available(chat_token, db):
+    ticket = await services.get_chat_ticket(chat_token, db)
+    if ticket is None:
         await websocket.close(1008, "Channel not found")
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Channel not found")
-    chat = db.query(models.TicketChat).filter(models.TicketChat.token == chat_token).first()
-    try:
-        if data[chat_token]["lock"]:
-            chat_f = 1
-    except KeyError:
-        if chat is not None:
-            data[chat_token] = {"auto_join": "true", "max_users": 2, "allow_dm_betwen_members": "true",
-                                "admin": [], "users": {}, "lock": asyncio.Lock()}
-    async with data[chat_token]["lock"]:
-        if not await validate_token(user_id=user_id, chat_token=chat_token, db=db):
-            await websocket.close(1008, "Not authorised")
-            raise HTTPException(status_code=401, detail="You are not authorized")
+    if user_id not in (ticket.user_id, ticket.mentor_id):
+        await websocket.close(1008, "Not authorised")
+        raise HTTPException(status_code=401, detail="You are not authorized")
+    if ticket.closed:
+        await websocket.close(1008, "Ticket closed")
+        raise HTTPException(status_code=400, detail="Ticket closed")
+    # the socket lives for hours and mostly waits; the session gets a pooled connection again only when a
+    # message is stored
+    await db.close()
+    # nothing below awaits until the socket is registered, so no lock is needed around the registry
+    channel = open_channel(chat_token, ticket.ticket_id, ticket.user_id, ticket.mentor_id)
+    participant = channel.participant(user_id)
+    # a reconnect replaces the previous socket, which is usually dead already; its handler sees that it is no
+    # longer registered when it ends
+    previous, participant.socket = participant.socket, websocket
+    channel.touch(participant)
+    if previous is not None:
         try:
-            if "socket" in data[chat_token]["users"][user_id]:
-                chat_f = 1
-        except KeyError:
-            data[chat_token]["users"][user_id] = {"name": user_id}
-
-        user2_id = str(chat.mentor_id) if user_id == str(chat.user_id) else str(chat.user_id)
-        try:
-            if "socket" in data[chat_token]["users"][user2_id]:
-                chat_f = 1
-        except KeyError:
-            data[chat_token]["users"][user2_id] = {"name": user2_id}
-        if "socket" not in data[chat_token]["users"][user_id]:
-            data[chat_token]["users"][user_id]["socket"] = websocket
+            await previous.close(1000, "Replaced by a new connection")
+        except Exception:
+            pass
+    await message_bus.bus.subscribe(CHAT_TOPIC, deliver)
+    await message_bus.bus.subscribe(message_bus.TICKET_CLOSED_TOPIC, ticket_closed)
     try:
+        if last_seen_id is not None:
+            await send_missed(websocket, ticket.ticket_id, last_seen_id)
         while True:
             data_to_send = await websocket.receive_text()
-            user2_id = str(chat.mentor_id) if user_id == str(chat.user_id) else str(chat.user_id)
-            await send_message(chat_token=chat_token, user_id=user_id, user2_id=user2_id,
-                               data_to_send=data_to_send, db=db)
+            await send_message(channel, participant, data_to_send, db)
     except (WebSocketDisconnect, WebSocketException):
-        async with data[chat_token]["lock"]:
-            del data[chat_token]["users"][user_id]
+        pass
+    except RuntimeError:
+        # a send from another task failed first and marked the socket disconnected
+        if websocket.application_state != WebSocketState.DISCONNECTED:
+            raise
+    finally:
+        # a failed delivery may have dropped this socket already and the user may have reconnected since
+        if participant.socket is websocket:
+            participant.socket = None
 
 
 @app.post("/ws/ticket/create")
 async def create_group(ticket: schemas.TicketBase,
-                       db: _orm.Session = fastapi.Depends(services.get_db)):
-    max_users = 2
-    open_tickets = db.query(models.TicketChat).filter(models.TicketChat.user_id == ticket.user_id).filter(
-        models.TicketChat.closed == False).all()
+                       db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    open_tickets = (await db.scalars(_sql.select(models.TicketChat).where(
+        models.TicketChat.user_id == ticket.user_id).where(models.TicketChat.closed == False))).all()
     if open_tickets != []:
         raise HTTPException(status_code=401, detail={'msg': "You have opened tickets"})
+    # the channel itself is opened by the first socket that connects
     chat_token = await new_chat_token(ticket.user_id, ticket.mentor_id, db)
-
-    data[chat_token] = {"auto_join": "true", "max_users": max_users, "allow_dm_betwen_members": "true",
-                        "admin": [], "users": {}, "lock": asyncio.Lock(), }
-    data[chat_token]["users"][str(ticket.user_id)] = {"name": ticket.user_id}
-    data[chat_token]["users"][str(ticket.mentor_id)] = {"name": ticket.mentor_id}
     return {"chat_token": chat_token}
 
 
-threading.Thread(target=cleanup_thread).start()
+@app.get("/ws/stats")
+async def channel_stats(user: models.User = fastapi.Depends(services.get_current_user)):
+    if user.role != 'admin':
+        raise HTTPException(status_code=400, detail={'msg': 'Нет доступа к данным'})
+    return {**expiry.stats(), 'bus': message_bus.bus.stats()}
+
+
+async def close_background_tasks():
+    # queued writes are committed first, they do not need the bus
+    if write_queue.coordinator is not None:
+        await write_queue.coordinator.close()
+    await expiry.close()
+    await message_bus.bus.close()
+
+
+app.add_event_handler('shutdown', close_background_tasks)
@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import json
+import random
+import resource
+import socket
+import sys
+import time
+
+import httpx
+import sqlalchemy as _sql
+import uvicorn
+import websockets
+
+import database as _database
+import models
+
+
+def _percentile(values: list, fraction: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _rss_kib(pid: int = None):
+    try:
+        with open(f'/proc/{pid or "self"}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # peak rather than current, but the best there is without /proc
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if pid is None else None
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _last_message_id():
+    with _database.SessionLocal() as db:
+        return db.scalar(_sql.select(_sql.func.coalesce(_sql.func.max(models.ChatMessage.id), 0)))
+
+
+def _count_messages(after_id: int):
+    with _database.SessionLocal() as db:
+        return db.scalar(_sql.select(_sql.func.count()).where(models.ChatMessage.id > after_id))
+
+
+def _stored_texts(after_id: int, prefix: str):
+    with _database.SessionLocal() as db:
+        return set(db.scalars(_sql.select(models.ChatMessage.message_text).where(
+            models.ChatMessage.id > after_id).where(models.ChatMessage.message_text.startswith(prefix))))
+
+
+def _close_tickets(tokens: list):
+    with _database.SessionLocal() as db:
+        db.execute(_sql.update(models.TicketChat).where(models.TicketChat.token.in_(tokens)).values(closed=True))
+        db.commit()
+
+
+class Client:
+    # one side of a ticket chat; records when the peer's messages arrive
+    def __init__(self, url: str, user_id: int, pending: dict, report: dict):
+        self.url = url
+        self.user_id = str(user_id)
+        # text -> send time, shared by both sides of the chat
+        self.pending = pending
+        self.report = report
+        self.websocket = None
+        self.reader = None
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.websocket = await websockets.connect(self.url, max_queue=None)
+        self.report['connect'].append(time.perf_counter() - started)
+        self.reader = asyncio.get_running_loop().create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for text in self.websocket:
+                message = json.loads(text)
+                # the sender gets its own message back as well, only the peer's copy is timed
+                if message['user_id'] == self.user_id:
+                    continue
+                sent = self.pending.pop(message['message_text'], None)
+                if sent is not None:
+                    self.report['rtt'].append(time.perf_counter() - sent)
+        except websockets.ConnectionClosed as closed:
+            self.report['closed'].append(closed.rcvd.code if closed.rcvd else None)
+
+    async def send(self, text: str):
+        self.pending[text] = time.perf_counter()
+        await self.websocket.send(text)
+        self.report['sent'] += 1
+
+    async def close(self):
+        await self.websocket.close()
+        await self.reader
+
+
+async def _pair(base_url: str, ws_url: str, http: httpx.AsyncClient, user_id: int, mentor_id: int, report: dict):
+    response = await http.post(f'{base_url}/ws/ticket/create', json={'user_id': user_id, 'mentor_id': mentor_id})
+    response.raise_for_status()
+    token = response.json()['chat_token']
+    report['tokens'].append(token)
+    pending = {}
+    worker = Client(f'{ws_url}/ws/chat?user_id={user_id}&chat_token={token}', user_id, pending, report)
+    mentor = Client(f'{ws_url}/ws/chat?user_id={mentor_id}&chat_token={token}', mentor_id, pending, report)
+    await worker.connect()
+    try:
+        await mentor.connect()
+    except BaseException:
+        await worker.close()
+        raise
+    return worker, mentor
+
+
+async def _talk(pair: tuple, rate: float, deadline: float, prefix: str):
+    interval = 1 / rate
+    await asyncio.sleep(random.random() * interval)
+    sequence = 0
+    while time.perf_counter() < deadline:
+        client = pair[sequence % 2]
+        await client.send(f'{prefix}{sequence}')
+        sequence += 1
+        await asyncio.sleep(interval)
+
+
+async def _drain(pending: list, timeout: float):
+    # waits for messages still on their way, up to timeout seconds
+    deadline = time.perf_counter() + timeout
+    while any(pending) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def _settle(after_id: int, prefix: str, undelivered: set):
+    # the server may still be working through messages it has received; wait until it stops storing any
+    stored = None
+    while True:
+        latest = await asyncio.to_thread(_stored_texts, after_id, prefix)
+        if undelivered <= latest or (stored is not None and len(latest) == len(stored)):
+            return latest
+        stored = latest
+        await asyncio.sleep(1)
+
+
+async def run(pairs: int, rate: float, duration: float, base_url: str = None, server_pid: int = None,
+              connect_concurrency: int = 50, drain_timeout: float = 5):
+    server = task = None
+    if base_url is None:
+        import chat_app
+        port = _free_port()
+        server = uvicorn.Server(uvicorn.Config(chat_app.app, host='127.0.0.1', port=port, log_level='warning'))
+        task = asyncio.get_running_loop().create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+        base_url = f'http://127.0.0.1:{port}'
+    ws_url = 'ws' + base_url[len('http'):]
+    report = {'connect': [], 'rtt': [], 'closed': [], 'tokens': [], 'sent': 0, 'connect_failures': 0}
+    first_id = await asyncio.to_thread(_last_message_id)
+    rss_before = _rss_kib(server_pid)
+    # synthetic ids far away from real users, so /ws/ticket/create does not find their open tickets
+    base_id = random.randrange(10 ** 8, 2 * 10 ** 8)
+    limit = asyncio.Semaphore(connect_concurrency)
+
+    async def open_pair(number: int):
+        async with limit:
+            try:
+                return await _pair(base_url, ws_url, http, base_id + 2 * number, base_id + 2 * number + 1, report)
+            except (OSError, httpx.HTTPError, websockets.WebSocketException):
+                # an overloaded server refusing connections is a result, not a reason to stop
+                report['connect_failures'] += 1
+
+    try:
+        async with httpx.AsyncClient(timeout=30) as http:
+            connected = [pair for pair in await asyncio.gather(*(open_pair(number) for number in range(pairs)))
+                         if pair is not None]
+        rss_connected = _rss_kib(server_pid)
+        started = time.perf_counter()
+        await asyncio.gather(*(_talk(pair, rate, started + duration, f'load {base_id} {number} ')
+                               for number, pair in enumerate(connected)))
+        await _drain([worker.pending for worker, _ in connected], drain_timeout)
+        elapsed = time.perf_counter() - started
+        # taken together, so every message sent is either delivered or undelivered
+        rtt = list(report['rtt'])
+        # whatever did not reach the peer in time was either stored and not delivered, or never stored at all
+        undelivered = {text for worker, _ in connected for text in worker.pending}
+        written = await asyncio.to_thread(_count_messages, first_id)
+        stored = await _settle(first_id, f'load {base_id} ', undelivered) if undelivered else set()
+        rss_after = _rss_kib(server_pid)
+        await asyncio.gather(*(client.close() for pair in connected for client in pair))
+    finally:
+        if report['tokens']:
+            await asyncio.to_thread(_close_tickets, report['tokens'])
+        if server is not None:
+            server.should_exit = True
+            await task
+            # pooled aiosqlite connections keep their threads, and the interpreter, alive
+            await _database.async_engine.dispose()
+    return {
+        'pairs': pairs,
+        'connect_failures': report['connect_failures'],
+        'connect_p50_ms': (_percentile(report['connect'], 0.5) or 0) * 1000,
+        'connect_p99_ms': (_percentile(report['connect'], 0.99) or 0) * 1000,
+        'messages_sent': report['sent'],
+        'messages_delivered': len(rtt),
+        'messages_late': len(undelivered & stored),
+        'messages_lost': len(undelivered - stored),
+        'rtt_p50_ms': (_percentile(rtt, 0.5) or 0) * 1000,
+        'rtt_p99_ms': (_percentile(rtt, 0.99) or 0) * 1000,
+        'db_writes_per_s': written / elapsed,
+        'rss_before_mib': rss_before and rss_before / 1024,
+        'rss_connected_mib': rss_connected and rss_connected / 1024,
+        'rss_after_mib': rss_after and rss_after / 1024,
+        'unexpected_closes': len(report['closed']),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Open paired ticket chats against chat_app and measure them. '
+                                                 'Tickets are created in DATABASE_URL, use a scratch database.')
+    parser.add_argument('--pairs', type=int, default=100, help='ticket chats, each with a worker and a mentor socket')
+    parser.add_argument('--rate', type=float, default=1, help='messages per second in each chat')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of messaging')
+    parser.add_argument('--url', help='running chat_app, e.g. http://127.0.0.1:8001; started in-process if omitted')
+    parser.add_argument('--server-pid', type=int, help='pid of the server at --url, for the RSS numbers')
+    parser.add_argument('--max-connect-failures', type=int, default=0,
+                        help='fail if more chats than this could not be opened')
+    parser.add_argument('--max-connect-p99', type=float, help='fail if connect p99 exceeds this many ms')
+    parser.add_argument('--max-rtt-p99', type=float, help='fail if round-trip p99 exceeds this many ms')
+    parser.add_argument('--drain-timeout', type=float, default=5,
+                        help='seconds to wait for messages still on their way once sending stops')
+    parser.add_argument('--max-lost', type=int, default=0, help='fail if more messages than this are never stored')
+    args = parser.parse_args()
+    if args.url and not args.server_pid:
+        print('no --server-pid, RSS is not measured')
+    result = asyncio.run(run(args.pairs, args.rate, args.duration, args.url, args.server_pid,
+                             drain_timeout=args.drain_timeout))
+    for name, value in result.items():
+        print(f'{name}: {value:.1f}' if isinstance(value, float) else f'{name}: {value}')
+    failed = [name for name, limit, value in (('connect_failures', args.max_connect_failures,
+                                               result['connect_failures']),
+                                              ('connect_p99_ms', args.max_connect_p99, result['connect_p99_ms']),
+                                              ('rtt_p99_ms', args.max_rtt_p99, result['rtt_p99_ms']),
+                                              ('messages_lost', args.max_lost, result['messages_lost']))
+              if limit is not None and value > limit]
+    if failed:
+        print('over the limit:', ', '.join(failed))
+        sys.exit(1)
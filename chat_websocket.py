@@ -1,21 +1,112 @@
+import asyncio
+import os
+
+import dotenv as _dotenv
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+
+import message_bus
+
+_dotenv.load_dotenv()
+
+# messages that may wait for one connection before it counts as a slow consumer
+WS_QUEUE_SIZE = int(os.environ.get('WS_QUEUE_SIZE', 256))
+# drop: disconnect a slow consumer, coalesce: throw away its backlog and keep only the newest message
+WS_SLOW_CONSUMER_POLICY = os.environ.get('WS_SLOW_CONSUMER_POLICY', 'drop')
+WS_CLOSE_TIMEOUT = float(os.environ.get('WS_CLOSE_TIMEOUT', 5))
+
+
+class Connection:
+    __slots__ = ('websocket', 'queue', 'writer')
+
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(queue_size)
+        self.writer = None
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    # broadcasts go through the message bus so that connections held by other processes receive them too;
+    # every connection has its own bounded queue and writer task, so one slow client does not hold up the rest
+    def __init__(self, topic: str = 'broadcast', queue_size: int = WS_QUEUE_SIZE,
+                 slow_consumer_policy: str = WS_SLOW_CONSUMER_POLICY):
+        self.topic = topic
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.active_connections: dict[WebSocket, Connection] = {}
+        self.dropped = 0
+        self.coalesced = 0
+        self._closing = set()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        connection = Connection(websocket, self.queue_size)
+        connection.writer = asyncio.get_running_loop().create_task(self._write(connection))
+        self.active_connections[websocket] = connection
+        await message_bus.bus.subscribe(self.topic, self.deliver)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        connection = self.active_connections.pop(websocket, None)
+        if connection is not None and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            self._enqueue(connection, ('text', message))
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
\ No newline at end of file
+        await message_bus.bus.publish(self.topic, message)
+
+    async def deliver(self, message: dict):
+        # only puts the message on the queues, the writer tasks send it
+        for connection in list(self.active_connections.values()):
+            self._enqueue(connection, ('json', message))
+
+    def _enqueue(self, connection: Connection, item: tuple):
+        try:
+            connection.queue.put_nowait(item)
+            return
+        except asyncio.QueueFull:
+            pass
+        if self.slow_consumer_policy == 'coalesce':
+            self.coalesced += connection.queue.qsize()
+            while not connection.queue.empty():
+                connection.queue.get_nowait()
+            connection.queue.put_nowait(item)
+            return
+        self.dropped += 1
+        self.disconnect(connection.websocket)
+        task = asyncio.get_running_loop().create_task(self._close(connection.websocket, 1013, 'Too slow'))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _write(self, connection: Connection):
+        websocket = connection.websocket
+        try:
+            while True:
+                items = [await connection.queue.get()]
+                # whatever queued up meanwhile is sent without waking up again for each message
+                while not connection.queue.empty():
+                    items.append(connection.queue.get_nowait())
+                for kind, message in items:
+                    # a client that stops reading blocks only here; its queue fills up and _enqueue deals with it
+                    if kind == 'json':
+                        await websocket.send_json(message)
+                    else:
+                        await websocket.send_text(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(websocket)
+            await self._close(websocket, 1011, 'Send failed')
+
+    async def _close(self, websocket: WebSocket, code: int, reason: str):
+        try:
+            await asyncio.wait_for(websocket.close(code, reason), WS_CLOSE_TIMEOUT)
+        except Exception:
+            pass
+
+    def stats(self):
+        queued = sum(connection.queue.qsize() for connection in self.active_connections.values())
+        return {'connections': len(self.active_connections), 'queued': queued, 'dropped': self.dropped,
+                'coalesced': self.coalesced}
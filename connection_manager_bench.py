@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import time
+
+import chat_websocket
+
+
+def _percentile(values: list, fraction: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class FakeWebSocket:
+    # stands in for a client; a slow one takes delay seconds for every send
+    def __init__(self, latencies: list, delay: float = 0):
+        self.latencies = latencies
+        self.delay = delay
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, message: dict):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.latencies.append(time.perf_counter() - message['sent'])
+
+    async def send_text(self, message: str):
+        pass
+
+    async def close(self, code: int = 1000, reason: str = None):
+        pass
+
+
+class SequentialManager:
+    # the manager before per-connection queues: one list, every send awaited in turn
+    def __init__(self):
+        self.active_connections = []
+
+    async def connect(self, websocket):
+        await websocket.accept()
+        self.active_connections.append(websocket)
+
+    async def deliver(self, message: dict):
+        for connection in self.active_connections:
+            await connection.send_json(message)
+
+
+async def run(connections: int, messages: int, slow: int, slow_delay: float, sequential: bool = False,
+              queue_size: int = 16, policy: str = 'drop'):
+    # deliver is called directly, the message bus is not part of what is measured
+    if sequential:
+        manager = SequentialManager()
+    else:
+        manager = chat_websocket.ConnectionManager(queue_size=queue_size, slow_consumer_policy=policy)
+    latencies = []
+    for number in range(connections):
+        await manager.connect(FakeWebSocket(latencies, slow_delay if number < slow else 0))
+    started = time.perf_counter()
+    for number in range(messages):
+        await manager.deliver({'sent': time.perf_counter(), 'number': number})
+        await asyncio.sleep(0)
+    fast = (connections - slow) * messages
+    while len(latencies) < fast:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    result = {
+        'deliveries_per_s': len(latencies) / elapsed,
+        'p50_ms': (_percentile(latencies, 0.5) or 0) * 1000,
+        'p99_ms': (_percentile(latencies, 0.99) or 0) * 1000,
+    }
+    if not sequential:
+        result.update(manager.stats())
+        for connection in list(manager.active_connections.values()):
+            manager.disconnect(connection.websocket)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fan messages out to fake clients through ConnectionManager')
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=20, help='messages delivered to every connection')
+    parser.add_argument('--slow', type=int, default=0, help='clients that take --slow-delay for every send')
+    parser.add_argument('--slow-delay', type=float, default=5)
+    parser.add_argument('--queue-size', type=int, default=16)
+    parser.add_argument('--policy', choices=('drop', 'coalesce'), default='drop')
+    parser.add_argument('--sequential', action='store_true', help='measure the old send-one-after-another manager')
+    args = parser.parse_args()
+    result = asyncio.run(run(args.connections, args.messages, args.slow, args.slow_delay, args.sequential,
+                             args.queue_size, args.policy))
+    for name, value in result.items():
+        print(f'{name}: {value:.1f}' if isinstance(value, float) else f'{name}: {value}')
@@ -1,11 +1,77 @@
+import os
+
+import dotenv as _dotenv
 import sqlalchemy
 from sqlalchemy.ext import declarative
+from sqlalchemy.ext import asyncio as _asyncio
+from sqlalchemy import event
 from sqlalchemy import orm
 
-DATABASE_URL = f"sqlite:///main.db"
+_dotenv.load_dotenv()
+
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///main.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))  # ms, postgres only
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # ms
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -64000))  # negative value is KiB
+
+_sync_drivers = {'sqlite+aiosqlite': 'sqlite', 'postgresql+asyncpg': 'postgresql'}
+_async_drivers = {'sqlite': 'sqlite+aiosqlite', 'sqlite+pysqlite': 'sqlite+aiosqlite',
+                  'postgresql': 'postgresql+asyncpg', 'postgresql+psycopg2': 'postgresql+asyncpg'}
+
+
+def _url(url: str, drivers: dict):
+    url = sqlalchemy.engine.make_url(url)
+    return url.set(drivername=drivers.get(url.drivername, url.drivername))
+
+
+def _engine_options(url: sqlalchemy.engine.URL, is_async: bool):
+    options = {'pool_pre_ping': DB_POOL_PRE_PING}
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return options
+        options['connect_args'] = {'timeout': SQLITE_BUSY_TIMEOUT / 1000}
+    elif url.get_backend_name() == 'postgresql':
+        if is_async:
+            options['connect_args'] = {'server_settings': {'statement_timeout': str(DB_STATEMENT_TIMEOUT)}}
+        else:
+            options['connect_args'] = {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'}
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+    return options
 
-engine = sqlalchemy.create_engine(DATABASE_URL)
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+    cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    cursor.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+    cursor.close()
+
+
+def _create_engine(url: sqlalchemy.engine.URL, is_async: bool):
+    options = _engine_options(url, is_async)
+    if is_async:
+        new_engine = _asyncio.create_async_engine(url, **options)
+        sync_engine = new_engine.sync_engine
+    else:
+        new_engine = sync_engine = sqlalchemy.create_engine(url, **options)
+    if url.get_backend_name() == 'sqlite':
+        event.listen(sync_engine, 'connect', _sqlite_pragmas)
+    return new_engine
+
+
+# sync engine is kept for sqladmin and alembic
+engine = _create_engine(_url(DATABASE_URL, _sync_drivers), is_async=False)
 
 SessionLocal = orm.sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = _create_engine(_url(DATABASE_URL, _async_drivers), is_async=True)
+
+AsyncSessionLocal = _asyncio.async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative.declarative_base()
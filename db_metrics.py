@@ -0,0 +1,100 @@
+import collections
+import contextvars
+import json
+import logging
+import os
+import re
+import time
+
+import dotenv as _dotenv
+from sqlalchemy import event
+
+import database
+
+_dotenv.load_dotenv()
+
+DEBUG = os.environ.get('DEBUG', 'false').lower() in ('1', 'true', 'yes')
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+
+slow_query_log = logging.getLogger('sql.slow')
+n_plus_one_log = logging.getLogger('sql.n_plus_one')
+
+_in_list = re.compile(r'\((\s*\?\s*,)+\s*\?\s*\)|\((\s*%\(\w+\)s\s*,)+\s*%\(\w+\)s\s*\)')
+_spaces = re.compile(r'\s+')
+
+
+class RequestStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.shapes = collections.Counter()
+
+    def record(self, statement: str, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.slowest:
+            self.slowest = elapsed
+            self.slowest_statement = statement
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated_shapes(self):
+        return {shape: count for shape, count in self.shapes.items() if count >= N_PLUS_ONE_THRESHOLD}
+
+
+_current = contextvars.ContextVar('db_request_stats', default=None)
+
+
+def statement_shape(statement: str):
+    # expanded IN lists differ only in placeholder count
+    return _in_list.sub('(?)', _spaces.sub(' ', statement).strip())
+
+
+def start_request():
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def finish_request(token):
+    _current.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    stats = _current.get()
+    if stats is not None:
+        stats.record(statement, elapsed)
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_query_log.warning(json.dumps({'duration_ms': round(elapsed * 1000, 2),
+                                           'statement': statement_shape(statement),
+                                           'executemany': executemany}, ensure_ascii=False))
+
+
+def log_request(method: str, path: str, stats: RequestStats):
+    repeated = stats.repeated_shapes()
+    if repeated:
+        n_plus_one_log.warning(json.dumps({'method': method, 'path': path, 'queries': stats.count,
+                                           'db_time_ms': round(stats.total * 1000, 2),
+                                           'repeated': [{'statement': shape, 'count': count}
+                                                        for shape, count in repeated.items()]},
+                                          ensure_ascii=False))
+    return repeated
+
+
+def debug_headers(stats: RequestStats, repeated: dict):
+    return {'X-DB-Query-Count': str(stats.count),
+            'X-DB-Time-Ms': f'{stats.total * 1000:.2f}',
+            'X-DB-Slowest-Ms': f'{stats.slowest * 1000:.2f}',
+            'X-DB-Slowest-Statement': statement_shape(stats.slowest_statement or '')[:200],
+            'X-DB-N-Plus-One': str(len(repeated))}
+
+
+for _engine in (database.engine, database.async_engine.sync_engine):
+    event.listen(_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(_engine, 'after_cursor_execute', _after_cursor_execute)
@@ -0,0 +1,85 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+
+import dotenv as _dotenv
+import fastapi
+from passlib.context import CryptContext
+
+_dotenv.load_dotenv()
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+
+# min/max pinned to the configured cost so hashes made with another cost are flagged for rehash on login
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__default_rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS,
+                           bcrypt__max_rounds=BCRYPT_ROUNDS)
+
+
+class HashingPool:
+    def __init__(self, workers: int, max_queued: int):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hashing')
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._max_queued_seen = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+
+    def _job(self, submitted: float, fn, args):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait_total += time.monotonic() - submitted
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    def _done(self, future: concurrent.futures.Future):
+        if future.cancelled():
+            with self._lock:
+                self._queued -= 1
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self._queued >= self.max_queued:
+                self._rejected += 1
+                raise fastapi.HTTPException(status_code=503, detail={'msg': 'Сервер перегружен, попробуйте позже'})
+            self._queued += 1
+            self._max_queued_seen = max(self._max_queued_seen, self._queued)
+        future = self._executor.submit(self._job, time.monotonic(), fn, args)
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'queued': self._queued, 'running': self._running,
+                    'max_queued': self._max_queued_seen, 'completed': self._completed,
+                    'rejected': self._rejected,
+                    'avg_wait_ms': self._wait_total / self._completed * 1000 if self._completed else 0}
+
+
+hashing_pool = HashingPool(workers=int(os.environ.get('PASSWORD_HASH_WORKERS', 2)),
+                           max_queued=int(os.environ.get('PASSWORD_HASH_QUEUE', 64)))
+
+
+async def hash_password(password: str):
+    return await hashing_pool.run(pwd_context.hash, password)
+
+
+async def verify_password(password: str, hashed_password: str):
+    return await hashing_pool.run(pwd_context.verify, password, hashed_password)
+
+
+async def verify_and_update(password: str, hashed_password: str):
+    # (valid, new_hash) - new_hash is set when the stored hash uses an outdated cost
+    return await hashing_pool.run(pwd_context.verify_and_update, password, hashed_password)
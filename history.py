@@ -1,63 +1,163 @@
-import sqlalchemy.orm as _orm
+import datetime
+import os
+
+import dotenv as _dotenv
+import sqlalchemy as _sql
+from sqlalchemy import event
+from sqlalchemy import orm
 
 import models
 
+_dotenv.load_dotenv()
+
+# every n-th version of a row is stored in full, the rest only carry the changed columns
+CHECKPOINT_EVERY = int(os.environ.get('HISTORY_CHECKPOINT_EVERY', 20))
+
+# model -> (history model, column keeping the source row id)
+TRACKED = {
+    models.User: (models.UserHistory, 'user_id'),
+    models.ReferralCode: (models.ReferralCodeHistory, 'referral_code_id'),
+    models.JoinCode: (models.JoinCodeHistory, None),
+    models.ClientInWork: (models.ClientInWorkHistory, 'client_id'),
+    models.TicketChat: (models.TicketChatHistory, 'ticket_id'),
+    models.PaymentCheck: (models.PaymentCheckHistory, 'payment_id'),
+}
+
+EXCLUDED = {'id', 'password'}
+
+# names used by the as-of endpoints
+ENTITIES = {
+    'user': models.UserHistory,
+    'client': models.ClientInWorkHistory,
+    'ticket': models.TicketChatHistory,
+    'payment': models.PaymentCheckHistory,
+}
+
+
+def _snapshot_columns(model, history_model):
+    history_columns = set(history_model.__table__.columns.keys())
+    return [column.key for column in _sql.inspect(model).column_attrs
+            if column.key not in EXCLUDED and column.key in history_columns]
+
+
+_columns = {model: _snapshot_columns(model, history_model) for model, (history_model, _) in TRACKED.items()}
+_history_columns = {history_model: _columns[model] for model, (history_model, _) in TRACKED.items()}
+_entity_column = {history_model: id_column for history_model, id_column in TRACKED.values()}
+
+
+def entity_column(history_model):
+    id_column = _entity_column[history_model]
+    return None if id_column is None else getattr(history_model, id_column)
+
+
+def _changed(obj):
+    state = _sql.inspect(obj)
+    return [key for key in _columns[type(obj)] if state.attrs[key].history.has_changes()]
+
+
+def _last_versions(session: orm.Session, history_model, ids: set):
+    id_column = getattr(history_model, _entity_column[history_model])
+    return dict(session.connection().execute(_sql.select(id_column, _sql.func.max(history_model.version)).where(
+        id_column.in_(ids)).group_by(id_column)).all())
+
+
+def _row(obj, changed: list, version: int, now: datetime.datetime):
+    history_model, id_column = TRACKED[type(obj)]
+    checkpoint = (version - 1) % CHECKPOINT_EVERY == 0
+    # unchanged columns are written as NULL so that every row of the batch has the same keys
+    row = {key: getattr(obj, key) if checkpoint or key in changed else None for key in _columns[type(obj)]}
+    row.update(version=version, checkpoint=checkpoint, changed_columns=','.join(changed))
+    if id_column is not None:
+        row[id_column] = obj.id
+    if 'change_time' in history_model.__table__.c:
+        row['change_time'] = now
+    return row
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def _write_history(session: orm.Session, flush_context):
+    # written on the flush connection, so the audit rows commit or roll back together with the change
+    now = datetime.datetime.now()
+    changes = {}
+    for obj in session.new:
+        if type(obj) in TRACKED:
+            changes.setdefault(TRACKED[type(obj)][0], []).append((obj, _columns[type(obj)]))
+    for obj in session.dirty:
+        if type(obj) in TRACKED:
+            changed = _changed(obj)
+            if changed:
+                changes.setdefault(TRACKED[type(obj)][0], []).append((obj, changed))
+    for history_model, objects in changes.items():
+        if _entity_column[history_model] is None:
+            versions = {}
+        else:
+            versions = _last_versions(session, history_model, {obj.id for obj, _ in objects})
+        rows = []
+        for obj, changed in objects:
+            version = versions.get(obj.id, 0) + 1
+            versions[obj.id] = version
+            rows.append(_row(obj, changed, version, now))
+        session.connection().execute(_sql.insert(history_model), rows)
+
+
+def _chain(history_model, entity_id, version):
+    # rows needed to rebuild a version: the last checkpoint at or before it and the deltas after it
+    id_column = getattr(history_model, _entity_column[history_model])
+    start = _sql.select(_sql.func.max(history_model.version)).where(id_column == entity_id).where(
+        history_model.checkpoint == True).where(history_model.version <= version).scalar_subquery()
+    return _sql.select(history_model).where(id_column == entity_id).where(
+        history_model.version >= start).where(history_model.version <= version).order_by(history_model.version)
+
+
+def chain_statement(record):
+    history_model = type(record)
+    return _chain(history_model, getattr(record, _entity_column[history_model]), record.version)
+
+
+def as_of_statement(history_model, entity_id: int, at: datetime.datetime):
+    id_column = getattr(history_model, _entity_column[history_model])
+    version = _sql.select(_sql.func.max(history_model.version)).where(id_column == entity_id).where(
+        history_model.change_time <= at).scalar_subquery()
+    return _chain(history_model, entity_id, version)
+
+
+def bulk_as_of_statement(history_model, entity_ids, at: datetime.datetime):
+    id_column = getattr(history_model, _entity_column[history_model])
+    target = _sql.select(id_column.label('entity_id'), _sql.func.max(history_model.version).label('version')).where(
+        id_column.in_(entity_ids)).where(history_model.change_time <= at).group_by(id_column).subquery()
+    start = _sql.select(id_column.label('entity_id'), _sql.func.max(history_model.version).label('version')).join(
+        target, target.c.entity_id == id_column).where(history_model.checkpoint == True).where(
+        history_model.version <= target.c.version).group_by(id_column).subquery()
+    return _sql.select(history_model).join(target, target.c.entity_id == id_column).join(
+        start, start.c.entity_id == id_column).where(history_model.version >= start.c.version).where(
+        history_model.version <= target.c.version).order_by(id_column, history_model.version)
+
+
+def reconstruct(rows: list):
+    values = {}
+    for row in rows:
+        keys = _history_columns[type(row)] if row.checkpoint else row.changed_columns.split(',')
+        values.update({key: getattr(row, key) for key in keys if key})
+    return values
+
+
+def reconstruct_many(rows: list):
+    # rows of several entities ordered by entity and version, as returned by bulk_as_of_statement
+    chains = {}
+    for row in rows:
+        chains.setdefault(getattr(row, _entity_column[type(row)]), []).append(row)
+    return {entity_id: state_of(chain) for entity_id, chain in chains.items()}
+
+
+def state_of(rows: list):
+    last = rows[-1]
+    state = reconstruct(rows)
+    state.update(id=getattr(last, _entity_column[type(last)]), version=last.version, change_time=last.change_time)
+    return state
+
 
-def add_user_history(user: models.User, model_name: str, db: _orm.Session):
-    user_record = models.UserHistory()
-    for attr, value in user.__dict__.items():
-        setattr(user_record, attr, value)
-    setattr(user_record, f'{model_name}_id', user.id)
-    db.add(user_record)
-    db.commit()
-    db.refresh(user_record)
-
-
-def add_referral_history(referral: models.ReferralCode, model_name: str, db: _orm.Session):
-    user_record = models.ReferralCodeHistory()
-    for attr, value in referral.__dict__.items():
-        setattr(user_record, attr, value)
-    setattr(user_record, f'{model_name}_id', referral.id)
-    db.add(user_record)
-    db.commit()
-    db.refresh(user_record)
-
-
-def add_join_history(join_code: models.JoinCode, model_name: str, db: _orm.Session):
-    user_record = models.ReferralCodeHistory()
-    for attr, value in join_code.__dict__.items():
-        setattr(user_record, attr, value)
-    setattr(user_record, f'{model_name}_id', join_code.id)
-    db.add(user_record)
-    db.commit()
-    db.refresh(user_record)
-
-
-def add_client_history(client: models.ClientInWork, model_name: str, db: _orm.Session):
-    user_record = models.ReferralCodeHistory()
-    for attr, value in client.__dict__.items():
-        setattr(user_record, attr, value)
-    setattr(user_record, f'{model_name}_id', client.id)
-    db.add(user_record)
-    db.commit()
-    db.refresh(user_record)
-
-
-def add_ticket_history(ticket: models.TicketChat, model_name: str, db: _orm.Session):
-    user_record = models.ReferralCodeHistory()
-    for attr, value in ticket.__dict__.items():
-        setattr(user_record, attr, value)
-    setattr(user_record, f'{model_name}_id', ticket.id)
-    db.add(user_record)
-    db.commit()
-    db.refresh(user_record)
-
-
-def add_payment_history(payment: models.PaymentCheck, model_name: str, db: _orm.Session):
-    user_record = models.ReferralCodeHistory()
-    for attr, value in payment.__dict__.items():
-        setattr(user_record, attr, value)
-    setattr(user_record, f'{model_name}_id', payment.id)
-    db.add(user_record)
-    db.commit()
-    db.refresh(user_record)
+def chain_as_of(rows: list, at: datetime.datetime):
+    # same selection as as_of_statement, over rows of one entity already in memory
+    rows = [row for row in rows if row.change_time is not None and row.change_time <= at]
+    starts = [index for index, row in enumerate(rows) if row.checkpoint]
+    return rows[starts[-1]:] if starts else []
@@ -5,8 +5,20 @@ import sqlalchemy as _sql
 from database import Base
 
 
-class UserHistory(Base):
+class ChangeLogMixin:
+    # checkpoint rows hold the full row, the others only the columns named in changed_columns
+    version = _sql.Column(_sql.Integer, default=1)
+    checkpoint = _sql.Column(_sql.Boolean, default=True)
+    changed_columns = _sql.Column(_sql.String, default='')
+
+
+class UserHistory(ChangeLogMixin, Base):
     __tablename__ = 'user_history'
+    __table_args__ = (
+        _sql.Index('ix_user_history_user_id_version', 'user_id', 'version'),
+        _sql.Index('ix_user_history_user_id_change_time', 'user_id', 'change_time'),
+        _sql.Index('ix_user_history_mentor_id', 'mentor_id'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     user_id = _sql.Column(_sql.Integer)
     email = _sql.Column(_sql.String)
@@ -25,8 +37,11 @@ class UserHistory(Base):
     change_time = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
 
 
-class ReferralCodeHistory(Base):
+class ReferralCodeHistory(ChangeLogMixin, Base):
     __tablename__ = 'referral_code_history'
+    __table_args__ = (
+        _sql.Index('ix_referral_code_history_referral_code_id_version', 'referral_code_id', 'version'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     referral_code_id = _sql.Column(_sql.Integer)
     username_id = _sql.Column(_sql.Integer)
@@ -34,7 +49,7 @@ class ReferralCodeHistory(Base):
     change_time = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
 
 
-class JoinCodeHistory(Base):
+class JoinCodeHistory(ChangeLogMixin, Base):
     __tablename__ = 'join_code_history'
     id = _sql.Column(_sql.Integer, primary_key=True)
     username_id = _sql.Column(_sql.Integer)
@@ -42,8 +57,12 @@ class JoinCodeHistory(Base):
     change_time = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
 
 
-class ClientInWorkHistory(Base):
+class ClientInWorkHistory(ChangeLogMixin, Base):
     __tablename__ = 'client_in_work_history'
+    __table_args__ = (
+        _sql.Index('ix_client_in_work_history_client_id_version', 'client_id', 'version'),
+        _sql.Index('ix_client_in_work_history_client_id_change_time', 'client_id', 'change_time'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     client_id = _sql.Column(_sql.Integer)
     start_time = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
@@ -60,8 +79,12 @@ class ClientInWorkHistory(Base):
     change_time = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
 
 
-class TicketChatHistory(Base):
+class TicketChatHistory(ChangeLogMixin, Base):
     __tablename__ = 'ticket_chat_history'
+    __table_args__ = (
+        _sql.Index('ix_ticket_chat_history_ticket_id_version', 'ticket_id', 'version'),
+        _sql.Index('ix_ticket_chat_history_ticket_id_change_time', 'ticket_id', 'change_time'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     ticket_id = _sql.Column(_sql.Integer)
     token = _sql.Column(_sql.String, default='')
@@ -71,8 +94,12 @@ class TicketChatHistory(Base):
     change_time = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
 
 
-class PaymentCheckHistory(Base):
+class PaymentCheckHistory(ChangeLogMixin, Base):
     __tablename__ = 'payment_check_history'
+    __table_args__ = (
+        _sql.Index('ix_payment_check_history_payment_id_version', 'payment_id', 'version'),
+        _sql.Index('ix_payment_check_history_payment_id_change_time', 'payment_id', 'change_time'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     payment_id = _sql.Column(_sql.Integer)
     username_id = _sql.Column(_sql.Integer, _sql.ForeignKey('user.id'))
@@ -80,6 +107,7 @@ class PaymentCheckHistory(Base):
     payment_details = _sql.Column(_sql.String, default='')
     value = _sql.Column(_sql.Float, default=0)
     state = _sql.Column(_sql.String, default='')
+    change_time = _sql.Column(_sql.DateTime, default=datetime.datetime.now)
 
 
 class TaskHistory(Base):
@@ -0,0 +1,126 @@
+import argparse
+import datetime
+import os
+import random
+import statistics
+import time
+
+import sqlalchemy as _sql
+
+import models
+
+# tables whose indexes are dropped for the "before" run and created again for the "after" run
+TABLES = [models.User, models.ClientInWork, models.ChatMessage, models.TicketChat, models.PaymentCheck]
+
+
+def _seed(engine, clients: int):
+    # one worker per 50 clients, one mentor and one manager per 20 workers, a ticket per 10 clients with
+    # one message per client spread over them
+    workers = max(1, clients // 50)
+    staff = max(1, workers // 20)
+    now = datetime.datetime.now()
+    rng = random.Random(1)
+    with engine.begin() as connection:
+        users = [{'id': number + 1, 'username': f'u{number}', 'email': f'u{number}@bench', 'role': 'worker',
+                  'mentor_id': workers + number % staff + 1, 'manager_id': workers + staff + number % staff + 1,
+                  'recruiter_id': 0, 'balance': 0} for number in range(workers)]
+        users += [{'id': workers + number + 1, 'username': f'm{number}', 'email': f'm{number}@bench',
+                   'role': 'mentor' if number < staff else 'manager', 'mentor_id': 0, 'manager_id': 0,
+                   'recruiter_id': 0, 'balance': 0} for number in range(2 * staff)]
+        connection.execute(_sql.insert(models.User), users)
+        for start in range(0, clients, 50000):
+            connection.execute(_sql.insert(models.ClientInWork), [
+                {'worker_id': number % workers + 1, 'manager_id': workers + staff + number % staff + 1,
+                 'status': rng.choice(('in_process', 'approved', 'rejected')), 'start_time': now,
+                 'deposit_date': now} for number in range(start, min(clients, start + 50000))])
+        tickets = max(1, clients // 10)
+        connection.execute(_sql.insert(models.TicketChat), [
+            {'id': number + 1, 'token': f't{number:08d}', 'user_id': number % workers + 1,
+             'mentor_id': workers + number % staff + 1, 'closed': number % 3 != 0} for number in range(tickets)])
+        for start in range(0, clients, 50000):
+            connection.execute(_sql.insert(models.ChatMessage), [
+                {'ticket_id': rng.randrange(tickets) + 1, 'user_id': 1, 'message_text': 'x', 'datetime': now}
+                for _ in range(start, min(clients, start + 50000))])
+        connection.execute(_sql.insert(models.PaymentCheck), [
+            {'username_id': number % workers + 1, 'state': rng.choice(('in_process', 'accepted', 'rejected'))}
+            for number in range(max(1, clients // 10))])
+    return workers, staff, tickets
+
+
+def _queries(workers: int, staff: int, tickets: int):
+    # the statement shapes the service layer runs, with a random id each time
+    client = models.ClientInWork
+    ticket = models.TicketChat
+    return {
+        'worker clients': lambda rng: _sql.select(client).where(client.worker_id == rng.randrange(workers) + 1).order_by(
+            client.id).limit(51),
+        'worker approved clients': lambda rng: _sql.select(_sql.func.count()).where(
+            client.worker_id == rng.randrange(workers) + 1).where(client.status == 'approved'),
+        'manager clients': lambda rng: _sql.select(client).where(
+            client.manager_id == workers + staff + rng.randrange(staff) + 1).order_by(client.id.desc()).limit(51),
+        'mentor team': lambda rng: _sql.select(models.User.id).where(
+            models.User.mentor_id == workers + rng.randrange(staff) + 1),
+        'ticket by token': lambda rng: _sql.select(ticket.id).where(ticket.token == f't{rng.randrange(tickets):08d}'),
+        'open tickets of mentor': lambda rng: _sql.select(ticket).where(
+            ticket.mentor_id == workers + rng.randrange(staff) + 1).where(ticket.closed == False),
+        'ticket chat page': lambda rng: _sql.select(models.ChatMessage).where(
+            models.ChatMessage.ticket_id == rng.randrange(tickets) + 1).order_by(models.ChatMessage.id).limit(51),
+        'pending payments': lambda rng: _sql.select(models.PaymentCheck).where(
+            models.PaymentCheck.username_id == rng.randrange(workers) + 1).where(
+            models.PaymentCheck.state == 'in_process'),
+    }
+
+
+def _measure(engine, queries: dict, repeat: int):
+    rng = random.Random(2)
+    timings = {}
+    with engine.connect() as connection:
+        for name, build in queries.items():
+            samples = []
+            for _ in range(repeat):
+                stmt = build(rng)
+                started = time.perf_counter()
+                connection.execute(stmt).all()
+                samples.append(time.perf_counter() - started)
+            timings[name] = statistics.median(samples) * 1000
+    return timings
+
+
+def _indexes():
+    return [index for model in TABLES for index in model.__table__.indexes]
+
+
+def run(path: str, clients: int, repeat: int):
+    if os.path.exists(path):
+        os.remove(path)
+    engine = _sql.create_engine(f'sqlite:///{path}')
+    models.Base.metadata.create_all(engine)
+    for index in _indexes():
+        index.drop(engine)
+    started = time.perf_counter()
+    workers, staff, tickets = _seed(engine, clients)
+    print(f'seeded {clients} clients in {time.perf_counter() - started:.0f}s')
+    queries = _queries(workers, staff, tickets)
+    with engine.begin() as connection:
+        connection.exec_driver_sql('ANALYZE')
+    before = _measure(engine, queries, repeat)
+    for index in _indexes():
+        index.create(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql('ANALYZE')
+    after = _measure(engine, queries, repeat)
+    engine.dispose()
+    return before, after
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the service query shapes on a seeded SQLite database, '
+                                                 'without and with the indexes declared in models.py')
+    parser.add_argument('--clients', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20, help='runs of every query, the median is reported')
+    parser.add_argument('--path', default='index_bench.db', help='scratch database, recreated on every run')
+    args = parser.parse_args()
+    before, after = run(args.path, args.clients, args.repeat)
+    print(f'{"query":<26}{"before ms":>12}{"after ms":>12}')
+    for name in before:
+        print(f'{name:<26}{before[name]:>12.2f}{after[name]:>12.2f}')
@@ -0,0 +1,62 @@
+import asyncio
+
+import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
+from sqlalchemy.dialects import postgresql, sqlite
+
+import database as _database
+import models
+
+
+def _insert(db: _asyncio.AsyncSession):
+    if db.bind.dialect.name == 'postgresql':
+        return postgresql.insert(models.WorkerScore)
+    return sqlite.insert(models.WorkerScore)
+
+
+async def apply_status_change(worker_id: int, old_status: str, new_status: str, db: _asyncio.AsyncSession):
+    # runs inside the caller's transaction, commit is up to the caller
+    delta = (new_status == 'approved') - (old_status == 'approved')
+    if delta == 0:
+        return
+    stmt = _insert(db).values(user_id=worker_id, closes=max(delta, 0))
+    stmt = stmt.on_conflict_do_update(index_elements=[models.WorkerScore.user_id],
+                                      set_={'closes': models.WorkerScore.closes + delta})
+    await db.execute(stmt)
+
+
+async def top(db: _asyncio.AsyncSession, limit: int = None):
+    stmt = _sql.select(models.User.username, models.WorkerScore.closes, models.User.balance).join(
+        models.User, models.User.id == models.WorkerScore.user_id).where(models.WorkerScore.closes > 0).order_by(
+        models.WorkerScore.closes.desc(), models.WorkerScore.user_id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return [{'username': row.username, 'closes': row.closes, 'balance': row.balance}
+            for row in await db.execute(stmt)]
+
+
+async def rank(user_id: int, db: _asyncio.AsyncSession):
+    closes = await db.scalar(_sql.select(models.WorkerScore.closes).where(models.WorkerScore.user_id == user_id))
+    if not closes:
+        return {'rank': None, 'closes': 0}
+    ahead = await db.scalar(_sql.select(_sql.func.count()).select_from(models.WorkerScore).where(
+        models.WorkerScore.closes > closes))
+    return {'rank': ahead + 1, 'closes': closes}
+
+
+async def rebuild(db: _asyncio.AsyncSession):
+    await db.execute(_sql.delete(models.WorkerScore))
+    await db.execute(_sql.insert(models.WorkerScore).from_select(
+        ['user_id', 'closes'],
+        _sql.select(models.ClientInWork.worker_id, _sql.func.count()).where(
+            models.ClientInWork.status == 'approved').group_by(models.ClientInWork.worker_id)))
+    await db.commit()
+
+
+async def _rebuild():
+    async with _database.AsyncSessionLocal() as db:
+        await rebuild(db)
+
+
+if __name__ == '__main__':
+    asyncio.run(_rebuild())
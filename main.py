@@ -1,7 +1,8 @@
+import datetime
 import os
 from typing import Annotated
 
-import sqlalchemy.orm as _orm
+import sqlalchemy.ext.asyncio as _asyncio
 from fastapi import UploadFile, Form
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
@@ -9,7 +10,10 @@ from jinja2 import Environment, PackageLoader, select_autoescape, FileSystemLoad
 from sqladmin import Admin
 from starlette.middleware.cors import CORSMiddleware
 from conf import *
+import db_metrics
+import pagination
 import schemas
+import write_queue
 from admin_models import *
 from chat_app import *
 from chat_websocket import ConnectionManager
@@ -33,6 +37,20 @@ app.add_middleware(CORSMiddleware,
                    allow_methods=["*"],
                    allow_headers=["*"])
 
+
+@app.middleware('http')
+async def sql_metrics(request: Request, call_next):
+    stats, token = db_metrics.start_request()
+    try:
+        response = await call_next(request)
+    finally:
+        db_metrics.finish_request(token)
+    repeated = db_metrics.log_request(request.method, request.url.path, stats)
+    if db_metrics.DEBUG:
+        response.headers.update(db_metrics.debug_headers(stats, repeated))
+    return response
+
+
 async def reset_password_email(email: str, password: str):
     template = env.get_template('password_reset.html')
     html = template.render(password=password).encode('utf-8')
@@ -51,9 +69,9 @@ async def create_user(file: UploadFile, email: Annotated[str, Form()], username:
                       password: Annotated[str, Form()], real_name: Annotated[str, Form()],
                       join_code: Annotated[str, Form()], role: Annotated[str, Form()],
                       phone_number: Annotated[str, Form()],
-                      db: _orm.Session = fastapi.Depends(services.get_db),
+                      db: _asyncio.AsyncSession = fastapi.Depends(services.get_db),
                       ref_link: str = ''):
-    db_user = services.get_user_by_email(email=email, db=db)
+    db_user = await services.get_user_by_email(email=email, db=db)
     if db_user:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Пользователь с данной почтой существует'})
     user_obj = schemas.UserCreate(username=username, password=password, email=email, join_code=join_code,
@@ -76,24 +94,25 @@ async def get_user(user: schemas.User = fastapi.Depends(services.get_current_use
 @app.post('/user/change')
 async def change_user_field(change_field: schemas.UserChangeField,
                             user: schemas.User = fastapi.Depends(services.get_current_user),
-                            db: _orm.Session = fastapi.Depends(services.get_db)):
+                            db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     user_change = await services.change_user_field(user.id, change_field, db)
     return user_change
 
 
 @app.post('/user/password/change')
-async def change_user_password(email_obj:schemas.PasswordChange, db: _orm.Session = fastapi.Depends(services.get_db)):
+async def change_user_password(email_obj:schemas.PasswordChange,
+                               db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     email = email_obj.email
     new_pass = secrets.token_hex(4)
-    pwd = services.change_user_password(email, new_pass, db)
+    pwd = await services.change_user_password(email, new_pass, db)
     await reset_password_email(email, new_pass)
     return new_pass
 
 
 @app.post('/user/avatar/add')
-def add_user_avatar(file: UploadFile, user: schemas.User = fastapi.Depends(services.get_current_user),
-                    db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.add_avatar(file, user, db)
+async def add_user_avatar(file: UploadFile, user: schemas.User = fastapi.Depends(services.get_current_user),
+                          db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.add_avatar(file, user, db)
 
 
 @app.options("/token", status_code=status.HTTP_200_OK)
@@ -106,7 +125,7 @@ def users_options():
 
 @app.post('/token')
 async def get_token(login_form: Annotated[OAuth2PasswordRequestForm, fastapi.Depends()],
-                    db: _orm.Session = fastapi.Depends(services.get_db)):
+                    db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     user = await services.authenticate_user(login_form.username, login_form.password, db)
     if not user:
         raise fastapi.HTTPException(
@@ -116,114 +135,153 @@ async def get_token(login_form: Annotated[OAuth2PasswordRequestForm, fastapi.Dep
     return {'access_token': await services.create_token(user=user)}
 
 
+@app.get('/metrics/hashing')
+async def get_hashing_metrics(user: models.User = fastapi.Depends(services.get_current_user)):
+    if user.role != 'admin':
+        raise fastapi.HTTPException(status_code=400, detail={'msg': 'Нет доступа к данным'})
+    return services.hashing.hashing_pool.stats()
+
+
+@app.get('/metrics/writes')
+async def get_write_metrics(user: models.User = fastapi.Depends(services.get_current_user)):
+    if user.role != 'admin':
+        raise fastapi.HTTPException(status_code=400, detail={'msg': 'Нет доступа к данным'})
+    if write_queue.coordinator is None:
+        return {'enabled': False}
+    return {'enabled': True, **write_queue.coordinator.stats()}
+
+
+# the same shutdown as the chat app's, from chat_app
+app.add_event_handler('shutdown', close_background_tasks)
+
+
 @app.get('/user/state')
-async def get_user_state(user: models.User = fastapi.Depends(services.get_current_user),
-                         db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.get_user_state(user, db)
+async def get_user_state(user: models.User = fastapi.Depends(services.get_token_user),
+                         db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.get_user_state(user, db)
 
 
 @app.get('/worker/clients')
-async def get_user_clients(user: models.User = fastapi.Depends(services.get_current_user),
-                           db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.get_user_clients(user, db)
+async def get_user_clients(user: models.User = fastapi.Depends(services.get_token_user),
+                           page: pagination.Page = fastapi.Depends(pagination.page_params),
+                           db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.get_user_clients(user, page, db)
 
 
 @app.get('/worker/clients/complete')
-async def get_user_clients_complete(user: models.User = fastapi.Depends(services.get_current_user),
-                                    db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.get_user_clients_complete(user, db)
+async def get_user_clients_complete(user: models.User = fastapi.Depends(services.get_token_user),
+                                    page: pagination.Page = fastapi.Depends(pagination.page_params),
+                                    db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.get_user_clients_complete(user, page, db)
 
 
 @app.post('/worker/client/edit')
-def edit_worker_client(client: schemas.ClientEdit, user: models.User = fastapi.Depends(services.get_current_user),
-                       db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.edit_client(client, user, db)
+async def edit_worker_client(client: schemas.ClientEdit, user: models.User = fastapi.Depends(services.get_current_user),
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.edit_client(client, user, db)
 
 
 @app.get('/worker/top')
-async def get_tasks_top(user: models.User = fastapi.Depends(services.get_current_user),
-                        db: _orm.Session = fastapi.Depends(services.get_db)):
+async def get_tasks_top(user: models.User = fastapi.Depends(services.get_token_user),
+                        db: _asyncio.AsyncSession = fastapi.Depends(services.get_db),
+                        limit: int = fastapi.Query(None, ge=1, le=pagination.MAX_PAGE_SIZE)):
     if user.role != 'worker':
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Данные недоступны'})
-    top = await services.get_tasks_top(db)
+    top = await services.get_tasks_top(db, limit)
     return top
 
 
+@app.get('/worker/top/rank')
+async def get_tasks_top_rank(user: models.User = fastapi.Depends(services.get_token_user),
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    if user.role != 'worker':
+        raise fastapi.HTTPException(status_code=400, detail={'msg': 'Данные недоступны'})
+    return await services.get_tasks_top_rank(user, db)
+
+
 @app.get('/worker/tickets/list')
-async def get_worker_tickets(user: models.User = fastapi.Depends(services.get_current_user),
-                             db: _orm.Session = fastapi.Depends(services.get_db)):
+async def get_worker_tickets(user: models.User = fastapi.Depends(services.get_token_user),
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     tickets = await services.get_worker_ticket(user, db)
     return tickets
 
 
 @app.get('/worker/managers')
 async def get_worker_managers(user: models.User = fastapi.Depends(services.get_current_user),
-                              db: _orm.Session = fastapi.Depends(services.get_db)):
+                              db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     managers = await services.get_worker_managers(user, db)
     return managers
 
 
 @app.get('/mission')
 async def get_missions(user: models.User = fastapi.Depends(services.get_current_user),
-                       db: _orm.Session = fastapi.Depends(services.get_db)):
+                       db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     mission = await services.get_tasks_user(user, db)
     return mission
 
 
 @app.get('/regulations')
-def get_regulations(db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.get_regulation(db)
+async def get_regulations(page: pagination.Page = fastapi.Depends(pagination.page_params),
+                          db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.get_regulation(page, db)
 
 
 @app.get('/study_materials')
-def get_study_material(db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.get_study_material(db)
+async def get_study_material(page: pagination.Page = fastapi.Depends(pagination.page_params),
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.get_study_material(page, db)
 
 
 @app.post('/client/add')
 async def add_new_client(client: schemas.ClientAdd, user: models.User = fastapi.Depends(services.get_current_user),
-                         db: _orm.Session = fastapi.Depends(services.get_db)):
+                         db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     new_client = await services.add_client(client, user, db)
     return new_client
 
 
 @app.post('/client/comment')
-async def add_client_comment(comment: schemas.ClientComment, db: _orm.Session = fastapi.Depends(services.get_db)):
+async def add_client_comment(comment: schemas.ClientComment,
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     client_comment = await services.add_client_comment(comment, db)
     return client_comment
 
 
 @app.get('/recruiter/team')
-async def get_recruiter_team(user: models.User = fastapi.Depends(services.get_current_user),
-                             db: _orm.Session = fastapi.Depends(services.get_db)):
-    team = await services.recruiter_team(user, db)
+async def get_recruiter_team(user: models.User = fastapi.Depends(services.get_token_user),
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db),
+                             limit: int = fastapi.Query(None, ge=1, le=pagination.MAX_PAGE_SIZE),
+                             offset: int = fastapi.Query(0, ge=0)):
+    team = await services.recruiter_team(user, db, limit, offset)
     return team
 
 
 @app.get('/recruiter/team/info')
-async def get_recruiter_team_info(user: models.User = fastapi.Depends(services.get_current_user),
-                                  db: _orm.Session = fastapi.Depends(services.get_db)):
+async def get_recruiter_team_info(user: models.User = fastapi.Depends(services.get_token_user),
+                                  db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     team_info = await services.recruiter_team_info(user, db)
     return team_info
 
 
 @app.get('/manager/clients')
-async def get_manager_clients(user: models.User = fastapi.Depends(services.get_current_user),
-                              db: _orm.Session = fastapi.Depends(services.get_db)):
-    clients = await services.get_manager_clients(user, db)
+async def get_manager_clients(user: models.User = fastapi.Depends(services.get_token_user),
+                              page: pagination.Page = fastapi.Depends(pagination.page_params),
+                              db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    clients = await services.get_manager_clients(user, page, db)
     return clients
 
 
 @app.get('/manager/team')
-async def get_manager_team(user: models.User = fastapi.Depends(services.get_current_user),
-                           db: _orm.Session = fastapi.Depends(services.get_db)):
-    team = await services.get_manager_team(user, db)
+async def get_manager_team(user: models.User = fastapi.Depends(services.get_token_user),
+                           db: _asyncio.AsyncSession = fastapi.Depends(services.get_db),
+                           limit: int = fastapi.Query(None, ge=1, le=pagination.MAX_PAGE_SIZE),
+                           offset: int = fastapi.Query(0, ge=0)):
+    team = await services.get_manager_team(user, db, limit, offset)
     return team
 
 
 @app.post('/manager/accept/client')
 async def accept_client(client: schemas.AcceptClient, user: models.User = fastapi.Depends(services.get_current_user),
-                        db: _orm.Session = fastapi.Depends(services.get_db)):
+                        db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     client = await services.accept_manager_client(client, user, db)
     return client
 
@@ -231,73 +289,82 @@ async def accept_client(client: schemas.AcceptClient, user: models.User = fastap
 @app.post('/manager/deposit/add/1')
 async def add_manager_deposit(deposit: schemas.AddDeposit,
                               user: models.User = fastapi.Depends(services.get_current_user),
-                              db: _orm.Session = fastapi.Depends(services.get_db)):
+                              db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     deposit_res = await services.add_manager_deposit(deposit, user, db)
     return deposit_res
 
 
 @app.post('/manager/call/add')
 async def add_manager_call(call: schemas.AddCall, user: models.User = fastapi.Depends(services.get_current_user),
-                           db: _orm.Session = fastapi.Depends(services.get_db)):
+                           db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     call_obj = await services.add_manager_call(call, user, db)
     return call_obj
 
 
 @app.get('/ticket/chat')
-async def get_ticket_chat(ticket: int, db: _orm.Session = fastapi.Depends(services.get_db)):
-    chat = await services.get_ticket_chat(ticket, db)
+async def get_ticket_chat(ticket: int, since: int = None, newest_first: bool = False,
+                          page: pagination.Page = fastapi.Depends(pagination.page_params),
+                          db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    # since=<last seen message id> returns only the messages after it, oldest first
+    if since is not None:
+        page, newest_first = pagination.Page(since, page.limit), False
+    chat = await services.get_ticket_chat(ticket, page, db, descending=newest_first)
     return chat
 
 
 @app.post('/ticket/close')
-async def close_ticket(ticket: schemas.TicketClose, db: _orm.Session = fastapi.Depends(services.get_db)):
+async def close_ticket(ticket: schemas.TicketClose, db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     ticket_1 = await services.close_ticket(ticket, db)
     return ticket_1
 
 
 @app.post('/payment/check/add')
 async def app_payment_check(check: schemas.PaymentCheck, user: models.User = fastapi.Depends(services.get_current_user),
-                            db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.add_payment_check(check, user, db)
+                            db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.add_payment_check(check, user, db)
 
 
 @app.get('/mentor/payment/check')
-async def get_payment_check(user: models.User = fastapi.Depends(services.get_current_user),
-                            db: _orm.Session = fastapi.Depends(services.get_db)):
-    payments = await services.get_payment_mentor(user, db)
+async def get_payment_check(user: models.User = fastapi.Depends(services.get_token_user),
+                            page: pagination.Page = fastapi.Depends(pagination.page_params),
+                            db: _asyncio.AsyncSession = fastapi.Depends(services.get_db),
+                            state: str = None):
+    payments = await services.get_payment_mentor(user, page, db, state)
     return payments
 
 
 @app.post('/mentor/payment/check/close')
 async def close_payment_check(payment: schemas.PaymentClose,
                               user: models.User = fastapi.Depends(services.get_current_user),
-                              db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.close_payment_mentor(payment, user, db)
+                              db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.close_payment_mentor(payment, user, db)
 
 
 @app.get('/mentor/users/list')
-async def get_users_mentors(user: models.User = fastapi.Depends(services.get_current_user),
-                            db: _orm.Session = fastapi.Depends(services.get_db)):
-    users = await services.get_mentor_users(user, db)
+async def get_users_mentors(user: models.User = fastapi.Depends(services.get_token_user),
+                            page: pagination.Page = fastapi.Depends(pagination.page_params),
+                            db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    users = await services.get_mentor_users(user, page, db)
     return users
 
 
 @app.post('/mentor/accept/user')
-def accept_user_request(user_data: schemas.UserAccept, user: models.User = fastapi.Depends(services.get_current_user),
-                        db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.accept_user(user_data, user, db)
+async def accept_user_request(user_data: schemas.UserAccept,
+                              user: models.User = fastapi.Depends(services.get_current_user),
+                              db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.accept_user(user_data, user, db)
 
 
 @app.get('/mentor/ticket/list')
-async def get_mentor_tickets(user: models.User = fastapi.Depends(services.get_current_user),
-                             db: _orm.Session = fastapi.Depends(services.get_db)):
+async def get_mentor_tickets(user: models.User = fastapi.Depends(services.get_token_user),
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     tickets = await services.get_mentor_ticket(user, db)
     return tickets
 
 
 @app.post('/mentor/tasks/add')
 async def app_mentor_task(task: schemas.MentorTask, user: models.User = fastapi.Depends(services.get_current_user),
-                          db: _orm.Session = fastapi.Depends(services.get_db)):
+                          db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     task_result = await services.add_mentor_task(task, user, db)
     return task_result
 
@@ -305,28 +372,28 @@ async def app_mentor_task(task: schemas.MentorTask, user: models.User = fastapi.
 @app.post('/mentor/tasks/edit')
 async def edit_mentor_tasks(task: schemas.MentorTaskEdit,
                             user: models.User = fastapi.Depends(services.get_current_user),
-                            db: _orm.Session = fastapi.Depends(services.get_db)):
+                            db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     task_res = await services.edit_mentor_tasks(task, user, db)
     return task_res
 
 
-@app.get('/mentor/tasks/new')
-async def get_mentor_tasks(user: models.User = fastapi.Depends(services.get_current_user),
-                           db: _orm.Session = fastapi.Depends(services.get_db)):
+@app.get('/mentor/tasks/new', response_model=list[schemas.MentorTaskOut])
+async def get_mentor_tasks(user: models.User = fastapi.Depends(services.get_token_user),
+                           db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     tasks = await services.get_new_tasks(user, db)
     return tasks
 
 
-@app.get('/mentor/tasks/active')
-async def get_mentor_tasks_active(user: models.User = fastapi.Depends(services.get_current_user),
-                                  db: _orm.Session = fastapi.Depends(services.get_db)):
+@app.get('/mentor/tasks/active', response_model=list[schemas.MentorTaskRequestOut])
+async def get_mentor_tasks_active(user: models.User = fastapi.Depends(services.get_token_user),
+                                  db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     tasks = await services.get_active_tasks(user, db)
     return tasks
 
 
-@app.get('/mentor/tasks/finished')
-async def get_mentor_tasks_finished(user: models.User = fastapi.Depends(services.get_current_user),
-                                    db: _orm.Session = fastapi.Depends(services.get_db)):
+@app.get('/mentor/tasks/finished', response_model=list[schemas.MentorTaskRequestOut])
+async def get_mentor_tasks_finished(user: models.User = fastapi.Depends(services.get_token_user),
+                                    db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     tasks = await services.get_finished_tasks(user, db)
     return tasks
 
@@ -334,34 +401,52 @@ async def get_mentor_tasks_finished(user: models.User = fastapi.Depends(services
 @app.post('/mentor/mission/submit')
 async def submit_mentor_task(task: schemas.MentorTaskSubmit,
                              user: models.User = fastapi.Depends(services.get_current_user),
-                             db: _orm.Session = fastapi.Depends(services.get_db)):
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     task = await services.submit_task_request(task, user, db)
     return task
 
 
 @app.get('/mentor/code')
-async def get_join_code(user: models.User = fastapi.Depends(services.get_current_user),
-                        db: _orm.Session = fastapi.Depends(services.get_db)):
+async def get_join_code(user: models.User = fastapi.Depends(services.get_token_user),
+                        db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     code = await services.get_mentor_code(user, db)
     return code
 
 
 @app.post('/mentor/worker/manager/add')
-def add_worker_manager(manager_add: schemas.AddManager, user: models.User = fastapi.Depends(services.get_current_user),
-                       db: _orm.Session = fastapi.Depends(services.get_db)):
-    return services.add_worker_manager(manager_add, user, db)
+async def add_worker_manager(manager_add: schemas.AddManager,
+                             user: models.User = fastapi.Depends(services.get_current_user),
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.add_worker_manager(manager_add, user, db)
 
 
 @app.get('/mentor/worker/clients')
-async def get_mentor_clients(user: models.User = fastapi.Depends(services.get_current_user),
-                             db: _orm.Session = fastapi.Depends(services.get_db)):
-    clients = await services.get_mentor_clients(user, db)
+async def get_mentor_clients(user: models.User = fastapi.Depends(services.get_token_user),
+                             page: pagination.Page = fastapi.Depends(pagination.page_params),
+                             db: _asyncio.AsyncSession = fastapi.Depends(services.get_db),
+                             status: str = None, worker_id: int = None, manager_id: int = None,
+                             date_from: datetime.datetime = None, date_to: datetime.datetime = None):
+    clients = await services.get_mentor_clients(user, page, db, status, worker_id, manager_id, date_from, date_to)
     return clients
 
 
+@app.get('/mentor/team/history')
+async def get_mentor_team_history(at: datetime.datetime, mentor_id: int = None,
+                                  user: models.User = fastapi.Depends(services.get_token_user),
+                                  db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.get_mentor_team_as_of(at, user, db, mentor_id)
+
+
+@app.get('/history/{entity}/{entity_id}')
+async def get_history_as_of(entity: str, entity_id: int, at: datetime.datetime,
+                            user: models.User = fastapi.Depends(services.get_token_user),
+                            db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
+    return await services.get_history_as_of(entity, entity_id, at, user, db)
+
+
 @app.get('/user/tasks')
 async def get_user_tasks(user: models.User = fastapi.Depends(services.get_current_user),
-                         db: _orm.Session = fastapi.Depends(services.get_db)):
+                         db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     tasks = await services.get_tasks_user(user, db)
     return tasks
 
@@ -369,21 +454,21 @@ async def get_user_tasks(user: models.User = fastapi.Depends(services.get_curren
 @app.post('/user/mission/take')
 async def send_task_request(task: schemas.MissionRequest,
                             user: models.User = fastapi.Depends(services.get_current_user),
-                            db: _orm.Session = fastapi.Depends(services.get_db)):
+                            db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     task_result = await services.send_task_request(task, user, db)
     return task_result
 
 
 @app.post('/user/mission/submit')
 async def send_task_request(task: schemas.MissionSubmit, user: models.User = fastapi.Depends(services.get_current_user),
-                            db: _orm.Session = fastapi.Depends(services.get_db)):
+                            db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     task_result = await services.send_task_request(task, user, db)
     return task_result
 
 
 @app.get('/user/mentor')
 async def get_user_mentor(user: models.User = fastapi.Depends(services.get_current_user),
-                          db: _orm.Session = fastapi.Depends(services.get_db)):
+                          db: _asyncio.AsyncSession = fastapi.Depends(services.get_db)):
     mentor = await services.get_user_mentor(user, db)
     return mentor
 
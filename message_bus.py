@@ -0,0 +1,250 @@
+import asyncio
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import dotenv as _dotenv
+
+_dotenv.load_dotenv()
+
+# local:// keeps everything in the process, sqlite:///chat_bus.db shares a notification table between processes
+# on one host, redis://[:password@]host:port uses redis pub/sub
+CHAT_BUS_URL = os.environ.get('CHAT_BUS_URL', 'local://')
+BUS_POLL_INTERVAL = float(os.environ.get('CHAT_BUS_POLL_MS', 20)) / 1000
+BUS_RETENTION = float(os.environ.get('CHAT_BUS_RETENTION', 60))  # seconds, sqlite only
+BUS_RECONNECT_DELAY = float(os.environ.get('CHAT_BUS_RECONNECT_DELAY', 1))
+
+TICKET_CLOSED_TOPIC = 'ticket_closed'
+
+
+class LocalBus:
+    # subscribers of this process are called directly on publish; other backends additionally forward the
+    # message to the other processes and skip their own messages when they come back
+    def __init__(self):
+        self.origin = secrets.token_hex(8)
+        self._handlers = {}
+        self.published = 0
+        self.received = 0
+
+    async def subscribe(self, topic: str, handler):
+        handlers = self._handlers.setdefault(topic, [])
+        if handler not in handlers:
+            handlers.append(handler)
+            await self._listen(topic)
+
+    def unsubscribe(self, topic: str, handler):
+        if handler in self._handlers.get(topic, []):
+            self._handlers[topic].remove(handler)
+
+    async def publish(self, topic: str, message: dict):
+        self.published += 1
+        payload = json.dumps({'origin': self.origin, 'message': message})
+        await self._deliver(topic, message)
+        await self._forward(topic, payload)
+
+    async def _deliver(self, topic: str, message: dict):
+        for handler in list(self._handlers.get(topic, [])):
+            try:
+                await handler(message)
+            except Exception as e:
+                print("ERROR (B01):", e)
+
+    async def _receive(self, topic: str, payload):
+        envelope = json.loads(payload)
+        if envelope['origin'] != self.origin:
+            self.received += 1
+            await self._deliver(topic, envelope['message'])
+
+    async def _listen(self, topic: str):
+        pass
+
+    async def _forward(self, topic: str, payload: str):
+        pass
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {'backend': type(self).__name__, 'published': self.published, 'received': self.received}
+
+
+class SqliteBus(LocalBus):
+    # processes append to a shared table and poll it for rows newer than the last one they have seen
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+        self._last_id = None
+        self._task = None
+        self._pruned = 0.0
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS bus_message (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                     'topic TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)')
+            self._last_id = self._connection.execute('SELECT coalesce(max(id), 0) FROM bus_message').fetchone()[0]
+        return self._connection
+
+    def _insert(self, topic: str, payload: str):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute('INSERT INTO bus_message (topic, payload, created) VALUES (?, ?, ?)',
+                               (topic, payload, now))
+            if now - self._pruned > BUS_RETENTION:
+                self._pruned = now
+                connection.execute('DELETE FROM bus_message WHERE created < ?', (now - BUS_RETENTION,))
+
+    def _fetch(self):
+        with self._lock:
+            rows = self._connect().execute('SELECT id, topic, payload FROM bus_message WHERE id > ? ORDER BY id',
+                                           (self._last_id,)).fetchall()
+        if rows:
+            self._last_id = rows[-1][0]
+        return rows
+
+    async def _listen(self, topic: str):
+        if self._task is None or self._task.done():
+            await asyncio.to_thread(self._fetch)
+            self._task = asyncio.get_running_loop().create_task(self._poll())
+
+    async def _poll(self):
+        while True:
+            try:
+                for _, topic, payload in await asyncio.to_thread(self._fetch):
+                    if topic in self._handlers:
+                        await self._receive(topic, payload)
+            except Exception as e:
+                print("ERROR (B02):", e)
+            await asyncio.sleep(BUS_POLL_INTERVAL)
+
+    async def _forward(self, topic: str, payload: str):
+        await asyncio.to_thread(self._insert, topic, payload)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def _command(*args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        arg = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError('redis closed the connection')
+    kind, value = line[:1], line[1:-2]
+    if kind == b'+':
+        return value.decode()
+    if kind == b'-':
+        raise RuntimeError(value.decode())
+    if kind == b':':
+        return int(value)
+    if kind == b'$':
+        if int(value) < 0:
+            return None
+        return (await reader.readexactly(int(value) + 2))[:-2]
+    if kind == b'*':
+        if int(value) < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(int(value))]
+    raise RuntimeError(f'unexpected redis reply {line!r}')
+
+
+class RedisBus(LocalBus):
+    # speaks the redis protocol directly: one connection publishes, one stays in subscribe mode
+    def __init__(self, url: str):
+        super().__init__()
+        url = urllib.parse.urlparse(url)
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or 6379
+        self.password = url.password
+        self._publisher = None
+        self._publish_lock = asyncio.Lock()
+        self._subscriber = None
+        self._task = None
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_command('AUTH', self.password))
+            await writer.drain()
+            await _read_reply(reader)
+        return reader, writer
+
+    async def _listen(self, topic: str):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._subscribe())
+        elif self._subscriber is not None:
+            self._subscriber.write(_command('SUBSCRIBE', topic))
+
+    async def _subscribe(self):
+        while True:
+            try:
+                reader, self._subscriber = await self._open()
+                self._subscriber.write(_command('SUBSCRIBE', *self._handlers))
+                while True:
+                    reply = await _read_reply(reader)
+                    if reply[0] == b'message':
+                        await self._receive(reply[1].decode(), reply[2])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("ERROR (B03):", e)
+                self._subscriber = None
+                await asyncio.sleep(BUS_RECONNECT_DELAY)
+
+    async def _forward(self, topic: str, payload: str):
+        async with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = await self._open()
+                    reader, writer = self._publisher
+                    writer.write(_command('PUBLISH', topic, payload))
+                    await writer.drain()
+                    return await _read_reply(reader)
+                except (ConnectionError, OSError):
+                    self._publisher = None
+                    if attempt:
+                        raise
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for writer in (self._subscriber, self._publisher and self._publisher[1]):
+            if writer is not None:
+                writer.close()
+        self._subscriber = self._publisher = None
+
+
+def create_bus(url: str):
+    scheme = urllib.parse.urlparse(url).scheme
+    if scheme == 'local':
+        return LocalBus()
+    if scheme == 'sqlite':
+        return SqliteBus(url[len('sqlite:///'):])
+    if scheme == 'redis':
+        return RedisBus(url)
+    raise ValueError(f'unsupported CHAT_BUS_URL {url}')
+
+
+bus = create_bus(CHAT_BUS_URL)
@@ -1,24 +1,22 @@
 import datetime
 
 import sqlalchemy as _sql
-from passlib.context import CryptContext
 
+from hashing import pwd_context
 from history_models import *
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 
 class User(Base):
     __tablename__ = 'user'
     id = _sql.Column(_sql.Integer, primary_key=True)
     email = _sql.Column(_sql.String, unique=True)
     username = _sql.Column(_sql.String, unique=True)
-    role = _sql.Column(_sql.String, default='')  # recruiter, worker, manager, future_worker, mentor, admin
+    role = _sql.Column(_sql.String, default='', index=True)  # recruiter, worker, manager, future_worker, mentor, admin
     password = _sql.Column(_sql.String, default='')
     access = _sql.Column(_sql.String, default='in_process')  # approved, in_process, rejected
-    recruiter_id = _sql.Column(_sql.Integer, default=0)
-    mentor_id = _sql.Column(_sql.Integer,  default=0)
-    manager_id = _sql.Column(_sql.Integer, default=0)
+    recruiter_id = _sql.Column(_sql.Integer, default=0, index=True)
+    mentor_id = _sql.Column(_sql.Integer,  default=0, index=True)
+    manager_id = _sql.Column(_sql.Integer, default=0, index=True)
     payment_type = _sql.Column(_sql.String, default=' ')
     payment_details = _sql.Column(_sql.String, default=' ')
     document_link = _sql.Column(_sql.String, default=' ')
@@ -35,30 +33,34 @@ class User(Base):
 class ReferralCode(Base):
     __tablename__ = 'referral_code'
     id = _sql.Column(_sql.Integer, primary_key=True)
-    username_id = _sql.Column(_sql.Integer)
-    code = _sql.Column(_sql.String, default='')
+    username_id = _sql.Column(_sql.Integer, index=True)
+    code = _sql.Column(_sql.String, default='', index=True)
 
 
 class JoinCode(Base):
     __tablename__ = 'join_code'
     id = _sql.Column(_sql.Integer, primary_key=True)
-    username_id = _sql.Column(_sql.Integer)
-    code = _sql.Column(_sql.String, default='')
+    username_id = _sql.Column(_sql.Integer, index=True)
+    code = _sql.Column(_sql.String, default='', index=True)
 
 
 class ClientInWork(Base):
     __tablename__ = 'client_in_work'
+    __table_args__ = (
+        _sql.Index('ix_client_in_work_worker_id_status', 'worker_id', 'status'),
+        _sql.Index('ix_client_in_work_worker_id_deposit_date', 'worker_id', 'deposit_date'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     start_time = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
     worker_id = _sql.Column(_sql.Integer)
-    manager_id = _sql.Column(_sql.Integer)
+    manager_id = _sql.Column(_sql.Integer, index=True)
     name = _sql.Column(_sql.String, default='')
     phone_number = _sql.Column(_sql.String, default='')
     city = _sql.Column(_sql.String, default='')
     call = _sql.Column(_sql.String, default='')
     from_who = _sql.Column(_sql.String, default='')
     link = _sql.Column(_sql.String, default='')
-    status = _sql.Column(_sql.String, default='in_process')  # accepted, in_process, rejected
+    status = _sql.Column(_sql.String, default='in_process', index=True)  # accepted, in_process, rejected
     comment = _sql.Column(_sql.String, default='')
     deposit_date = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
     deposit = _sql.Column(_sql.Boolean, default=False)
@@ -66,8 +68,41 @@ class ClientInWork(Base):
 
 
 
+class WorkerScore(Base):
+    # approved clients per worker, kept in step by leaderboard.apply_status_change
+    __tablename__ = 'worker_score'
+    __table_args__ = (
+        _sql.Index('ix_worker_score_closes_user_id', 'closes', 'user_id'),
+    )
+    user_id = _sql.Column(_sql.Integer, primary_key=True)
+    closes = _sql.Column(_sql.Integer, default=0, nullable=False)
+
+
+class ArchiveBlock(Base):
+    # one compressed block of archived rows in a segment file, see archive.py
+    __tablename__ = 'archive_block'
+    __table_args__ = (
+        _sql.Index('ix_archive_block_kind_key', 'kind', 'key'),
+    )
+    id = _sql.Column(_sql.Integer, primary_key=True)
+    kind = _sql.Column(_sql.String, nullable=False)
+    key = _sql.Column(_sql.Integer, nullable=False)
+    segment = _sql.Column(_sql.String, nullable=False)
+    offset = _sql.Column(_sql.Integer, nullable=False)
+    length = _sql.Column(_sql.Integer, nullable=False)
+    row_count = _sql.Column(_sql.Integer, nullable=False)
+    first_id = _sql.Column(_sql.Integer)
+    last_id = _sql.Column(_sql.Integer)
+    created = _sql.Column(_sql.DateTime, default=datetime.datetime.now)
+
+
 class ChatMessage(Base):
     __tablename__ = 'chat_message'
+    # ids are never reused, even after the newest rows went to the archive: clients page and resume by id
+    __table_args__ = (
+        _sql.Index('ix_chat_message_ticket_id_id', 'ticket_id', 'id'),
+        {'sqlite_autoincrement': True},
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     ticket_id = _sql.Column(_sql.Integer)
     datetime = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
@@ -77,8 +112,12 @@ class ChatMessage(Base):
 
 class TicketChat(Base):
     __tablename__ = 'ticket_chat'
+    __table_args__ = (
+        _sql.Index('ix_ticket_chat_user_id_closed', 'user_id', 'closed'),
+        _sql.Index('ix_ticket_chat_mentor_id_closed', 'mentor_id', 'closed'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
-    token = _sql.Column(_sql.String, default='')
+    token = _sql.Column(_sql.String, default='', index=True)
     user_id = _sql.Column(_sql.Integer)
     mentor_id = _sql.Column(_sql.Integer)
     closed = _sql.Column(_sql.Boolean, default=False)
@@ -123,6 +162,9 @@ class Regulation(Base):
 
 class PaymentCheck(Base):
     __tablename__ = 'payment_check'
+    __table_args__ = (
+        _sql.Index('ix_payment_check_username_id_state', 'username_id', 'state'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     username_id = _sql.Column(_sql.Integer)
     payment_type = _sql.Column(_sql.String, default='')
@@ -133,11 +175,14 @@ class PaymentCheck(Base):
 
 class Task(Base):
     __tablename__ = 'task'
+    __table_args__ = (
+        _sql.Index('ix_task_category_username', 'category', 'username'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     name = _sql.Column(_sql.String, default='')
     aim = _sql.Column(_sql.String, default='')
     award = _sql.Column(_sql.Float, default=0)
-    mentor_id = _sql.Column(_sql.Integer)
+    mentor_id = _sql.Column(_sql.Integer, index=True)
     category = _sql.Column(_sql.String, default='')  # worker, manager, one_user
     username = _sql.Column(_sql.String, default='')
     date = _sql.Column(_sql.DateTime, default=datetime.datetime.now())
@@ -145,6 +190,10 @@ class Task(Base):
 
 class TaskRequest(Base):
     __tablename__ = 'task_request'
+    __table_args__ = (
+        _sql.Index('ix_task_request_task_id_status', 'task_id', 'status'),
+        _sql.Index('ix_task_request_user_id_task_id', 'user_id', 'task_id'),
+    )
     id = _sql.Column(_sql.Integer, primary_key=True)
     task_id = _sql.Column(_sql.Integer)
     user_id = _sql.Column(_sql.Integer)
@@ -0,0 +1,56 @@
+import base64
+import binascii
+import json
+import os
+
+import dotenv as _dotenv
+import fastapi
+import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
+
+_dotenv.load_dotenv()
+
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+
+
+class Page:
+    def __init__(self, after, limit: int):
+        self.after = after
+        self.limit = limit
+
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps([value]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        value, = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError, TypeError):
+        raise fastapi.HTTPException(status_code=400, detail={'msg': 'Некорректный курсор'})
+    # every listing pages on an integer id
+    if type(value) is not int:
+        raise fastapi.HTTPException(status_code=400, detail={'msg': 'Некорректный курсор'})
+    return value
+
+
+def page_params(cursor: str = None, limit: int = fastapi.Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    return Page(decode_cursor(cursor) if cursor else None, limit)
+
+
+def apply(stmt, page: Page, column, descending: bool = False):
+    # keyset on a unique column: rows strictly after the cursor, one extra row to detect the next page
+    if page.after is not None:
+        stmt = stmt.where(column < page.after if descending else column > page.after)
+    return stmt.order_by(column.desc() if descending else column).limit(page.limit + 1)
+
+
+def envelope(items: list, page: Page, key=lambda item: item.id):
+    has_more = len(items) > page.limit
+    items = items[:page.limit]
+    return {'items': items, 'next_cursor': encode_cursor(key(items[-1])) if has_more else None, 'has_more': has_more}
+
+
+async def paginate(stmt, page: Page, column, db: _asyncio.AsyncSession, descending: bool = False):
+    return envelope((await db.scalars(apply(stmt, page, column, descending))).all(), page)
@@ -1,4 +1,5 @@
 import datetime
+from typing import Optional
 
 from pydantic import BaseModel
 
@@ -120,6 +121,33 @@ class MentorTask(BaseModel):
     username: str = ''
 
 
+class MentorTaskOut(BaseModel):
+    id: int
+    name: Optional[str] = ''
+    aim: Optional[str] = ''
+    award: Optional[float] = 0
+    mentor_id: Optional[int] = None
+    category: Optional[str] = ''
+    username: Optional[str] = ''
+    date: Optional[datetime.datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class MentorTaskRequestOut(BaseModel):
+    id: int
+    task_id: int
+    user_id: Optional[int] = None
+    status: Optional[str] = ''
+    comment: Optional[str] = ''
+    date: Optional[datetime.datetime] = None
+    aim: Optional[str] = ''
+    award: Optional[float] = 0
+    username: Optional[str] = ''
+    category: Optional[str] = ''
+
+
 class MentorTaskEdit(BaseModel):
     task_id: int
     aim: str = ''
@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import os
 import random
@@ -8,52 +9,58 @@ import email_validator
 import fastapi
 import fastapi.security as security
 import jwt
+import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
 import sqlalchemy.orm as _orm
-from passlib.context import CryptContext
 from sqlalchemy import exc
 from conf import *
+import archive
 import database as _database
+import hashing
+import history  # registers the audit-history flush hook
+import leaderboard
+import message_bus
+import models
+import pagination
 import schemas
-from history import *
+import write_queue
+from cache import identity_cache, feed_cache, feed_generation, ticket_cache, TicketAuth, TRUST_TOKEN_CLAIMS
 
 _dotenv.load_dotenv()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2schema = security.OAuth2PasswordBearer("/token")
 
 
-def get_db():
-    db = _database.SessionLocal()
-    try:
+async def get_db():
+    async with _database.AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def get_user_by_id(id: int, db: _orm.Session):
-    return db.query(models.User).filter(models.User.id == id).first()
+async def get_user_by_id(id: int, db: _asyncio.AsyncSession):
+    return await db.scalar(_sql.select(models.User).where(models.User.id == id).limit(1))
 
 
-def get_user_by_username(username: str, db: _orm.Session):
-    return db.query(models.User).filter(models.User.username == username).first()
+async def get_user_by_username(username: str, db: _asyncio.AsyncSession):
+    return await db.scalar(_sql.select(models.User).where(models.User.username == username).limit(1))
 
 
-def get_user_by_email(email: str, db: _orm.Session):
-    return db.query(models.User).filter(models.User.email == email).first()
+async def get_user_by_email(email: str, db: _asyncio.AsyncSession):
+    return await db.scalar(_sql.select(models.User).where(models.User.email == email).limit(1))
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await hashing.verify_password(plain_password, hashed_password)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await hashing.hash_password(password)
 
 
-def change_user_password(email: str, password: str, db: _orm.Session):
-    user = get_user_by_email(email, db)
-    user.password = get_password_hash(password)
-    db.commit()
+async def change_user_password(email: str, password: str, db: _asyncio.AsyncSession):
+    user = await get_user_by_email(email, db)
+    user.password = await get_password_hash(password)
+    await db.commit()
+    identity_cache.invalidate(user.id)
 
 
 async def create_token(user: models.User):
@@ -66,38 +73,52 @@ async def create_token(user: models.User):
     return token
 
 
-async def get_current_user(db: _orm.Session = fastapi.Depends(get_db),
+async def get_current_user(db: _asyncio.AsyncSession = fastapi.Depends(get_db),
                            token: str = fastapi.Depends(oauth2schema)):
     try:
         payload = jwt.decode(token, os.environ['SECRET_KEY'], algorithms=[os.environ['ALGORITHM']])
-        user = db.query(models.User).get(payload['id'])
-
+        user = identity_cache.get(payload['id'])
+        if user is None:
+            user = schemas.User.from_orm(await db.get(models.User, payload['id']))
+            identity_cache.set(user.id, user)
     except:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Неверные данные'})
-    return schemas.User.from_orm(user)
+    return user
 
 
-async def authenticate_user(username: str, password: str, db: _orm.Session):
-    user_username = get_user_by_username(username=username, db=db)
-    user_email = get_user_by_email(username, db)
-    if (not user_username) and (not user_email):
-        return False
+async def get_token_user(db: _asyncio.AsyncSession = fastapi.Depends(get_db),
+                         token: str = fastapi.Depends(oauth2schema)):
+    # read-only endpoints: id/role from the signed token are enough
+    if not TRUST_TOKEN_CLAIMS:
+        return await get_current_user(db, token)
     try:
-        if (not user_username.verify_password(password)) and (not user_email.verify_password(password)):
-            return False
-    except AttributeError:
-        return False
+        payload = jwt.decode(token, os.environ['SECRET_KEY'], algorithms=[os.environ['ALGORITHM']])
+        return schemas.User(**payload)
+    except:
+        raise fastapi.HTTPException(status_code=400, detail={'msg': 'Неверные данные'})
 
-    return user_email if user_email else user_username
 
+async def authenticate_user(username: str, password: str, db: _asyncio.AsyncSession):
+    users = (await db.scalars(_sql.select(models.User).where(
+        _sql.or_(models.User.username == username, models.User.email == username)))).all()
+    users.sort(key=lambda x: x.email != username)
+    for user in users:
+        valid, new_hash = await hashing.verify_and_update(password, user.password)
+        if valid:
+            if new_hash is not None:
+                user.password = new_hash
+                await db.commit()
+            return user
+    return False
 
-async def create_user(file, user: schemas.UserCreate, ref_link: str, db: _orm.Session):
+
+async def create_user(file, user: schemas.UserCreate, ref_link: str, db: _asyncio.AsyncSession):
     try:
-        valid = email_validator.validate_email(user.email)
+        valid = await asyncio.to_thread(email_validator.validate_email, user.email)
     except:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Введите действительный email'})
-    ref_link = db.query(models.ReferralCode).filter(models.ReferralCode.code == ref_link).all()
-    join_code = db.query(models.JoinCode).filter(models.JoinCode.code == user.join_code).all()
+    ref_link = (await db.scalars(_sql.select(models.ReferralCode).where(models.ReferralCode.code == ref_link))).all()
+    join_code = (await db.scalars(_sql.select(models.JoinCode).where(models.JoinCode.code == user.join_code))).all()
     if ref_link != [] and join_code != []:
         recruiter = ref_link[0].username_id
         mentor_id = join_code[0].username_id
@@ -105,501 +126,599 @@ async def create_user(file, user: schemas.UserCreate, ref_link: str, db: _orm.Se
                                document_link=f'{site_url}/api/staticfiles' + user.username + ".png",
                                recruiter_id=recruiter,
                                real_name=user.real_name,
-                               password=get_password_hash(user.password), mentor_id=mentor_id,
+                               password=await get_password_hash(user.password), mentor_id=mentor_id,
                                phone_number=user.phone_number)
         try:
             db.add(user_obj)
-            db.commit()
-            db.refresh(user_obj)
+            await db.commit()
+            await db.refresh(user_obj)
             with open(f'/var/www/staticfiles/kyc/{user.username}.png', 'wb') as out_file:
                 content = file.file.read()
                 out_file.write(content)
                 file.file.close()
-            add_user_history(user_obj, 'user', db)
             return user_obj
         except exc.IntegrityError:
-            db.rollback()
+            await db.rollback()
             raise fastapi.HTTPException(status_code=400, detail={'msg': 'Пользователь уже существует'})
     else:
         raise fastapi.HTTPException(status_code=400,
                                     detail={'msg': 'Реферальная ссылка или пригласительный код не существуют'})
 
 
-async def add_mentor_code(username: int, db: _orm.Session):
-    user = db.query(models.User).filter(models.User.username == username).first()
+async def add_mentor_code(username: int, db: _asyncio.AsyncSession):
+    user = await db.scalar(_sql.select(models.User).where(models.User.username == username).limit(1))
     join_code = models.JoinCode(username_id=user.id, code=str(random.randint(100000, 999999)))
     db.add(join_code)
-    db.commit()
-    db.refresh(join_code)
+    await db.commit()
+    await db.refresh(join_code)
 
 
-async def get_mentor_code(user: models.User, db: _orm.Session):
-    join_code = db.query(models.JoinCode).filter(models.JoinCode.username_id == user.id).first()
+async def get_mentor_code(user: models.User, db: _asyncio.AsyncSession):
+    join_code = await db.scalar(_sql.select(models.JoinCode).where(models.JoinCode.username_id == user.id).limit(1))
     return join_code.code
 
 
-async def get_worker_managers(user: models.User, db: _orm.Session):
+async def get_worker_managers(user: models.User, db: _asyncio.AsyncSession):
     if user.manager_id == 0:
-        return db.query(models.User).filter(models.User.role == 'manager').all()
-    return [db.query(models.User).get(user.manager_id)]
+        return (await db.scalars(_sql.select(models.User).where(models.User.role == 'manager'))).all()
+    return [await db.get(models.User, user.manager_id)]
 
 
-async def change_user_field(user_id: int, fields: schemas.UserChangeField, db: _orm.Session):
-    user = db.query(models.User).get(user_id)
+async def change_user_field(user_id: int, fields: schemas.UserChangeField, db: _asyncio.AsyncSession):
+    user = await db.get(models.User, user_id)
     fields_list = ['real_name', 'username', 'email', 'payment_type', 'payment_details']
     for field in fields_list:
         if getattr(fields, field) is not None:
             setattr(user, field, getattr(fields, field))
     if (fields.new_password_1 is not None) and (fields.new_password_1 == fields.new_password_2):
-        setattr(user, 'password', get_password_hash(fields.new_password_1))
-    db.commit()
-    add_user_history(user, 'user', db)
+        setattr(user, 'password', await get_password_hash(fields.new_password_1))
+    await db.commit()
+    identity_cache.invalidate(user_id)
 
 
-def add_avatar(file, user: models.User, db: _orm.Session):
+async def add_avatar(file, user: models.User, db: _asyncio.AsyncSession):
     with open('/var/www/staticfiles/avatars/' + user.username + '.png', 'wb') as out_file:
         content = file.file.read()
         out_file.write(content)
         file.file.close()
-    user_obj = db.query(models.User).get(user.id)
+    user_obj = await db.get(models.User, user.id)
     user_obj.avatar_link = f'{site_url}/api/static' + user.username + '.png'
-    db.commit()
+    await db.commit()
+    identity_cache.invalidate(user.id)
     return {'msg': 'ok'}
 
 
-def get_user_clients(user: models.User, db: _orm.Session):
-    clients = db.query(models.ClientInWork).filter(models.ClientInWork.worker_id == user.id).all()
-    managers = db.query(models.User).filter(models.User.role == 'manager').all()
-    for i in range(len(clients)):
-        manager_name = manager_username(managers, clients[i].manager_id)
-        setattr(clients[i], 'manager_name', manager_name)
-    return clients
+async def _clients_with_manager(stmt, page: pagination.Page, db: _asyncio.AsyncSession, descending: bool = False):
+    manager = _orm.aliased(models.User)
+    stmt = stmt.add_columns(manager.username).outerjoin(
+        manager, _sql.and_(manager.id == models.ClientInWork.manager_id, manager.role == 'manager'))
+    clients = []
+    for client, manager_name in await db.execute(pagination.apply(stmt, page, models.ClientInWork.id, descending)):
+        setattr(client, 'manager_name', manager_name)
+        clients.append(client)
+    return pagination.envelope(clients, page)
+
 
+async def get_user_clients(user: models.User, page: pagination.Page, db: _asyncio.AsyncSession):
+    return await _clients_with_manager(_sql.select(models.ClientInWork).where(
+        models.ClientInWork.worker_id == user.id), page, db)
 
-def edit_client(client: schemas.ClientEdit, user: models.User, db: _orm.Session):
+
+async def edit_client(client: schemas.ClientEdit, user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'worker':
-        client_model = db.query(models.ClientInWork).get(client.id)
+        client_model = await db.get(models.ClientInWork, client.id)
         client_obj = client.__dict__
         for field in ['name', 'phone_number', 'city', 'start_time',
                       'from_who', 'call', 'link', 'manager_id', ]:
             if client_obj[field] is not None:
                 setattr(client_model, field, client_obj[field])
-        db.commit()
+        await db.commit()
 
 
 # client
-def get_user_clients_complete(user: models.User, db: _orm.Session):
-    tasks = db.query(models.ClientInWork).filter(models.ClientInWork.worker_id == user.id).filter(
-        models.ClientInWork.status == 'approved').all()
-    return tasks
+async def get_user_clients_complete(user: models.User, page: pagination.Page, db: _asyncio.AsyncSession):
+    return await pagination.paginate(_sql.select(models.ClientInWork).where(
+        models.ClientInWork.worker_id == user.id).where(models.ClientInWork.status == 'approved'),
+        page, models.ClientInWork.id, db)
 
 
-async def get_manager_clients(user: models.User, db: _orm.Session):
-    clients = db.query(models.ClientInWork).filter(models.ClientInWork.manager_id == user.id).all()
-    clients.reverse()
-    return clients
+async def get_manager_clients(user: models.User, page: pagination.Page, db: _asyncio.AsyncSession):
+    return await pagination.paginate(_sql.select(models.ClientInWork).where(
+        models.ClientInWork.manager_id == user.id), page, models.ClientInWork.id, db, descending=True)
 
 
-async def add_ref_link(username_id: int, db: _orm.Session):
+async def add_ref_link(username_id: int, db: _asyncio.AsyncSession):
     link = secrets.token_hex(4)
     referal = models.ReferralCode(code=link, username_id=username_id)
     db.add(referal)
-    db.commit()
-    db.refresh(referal)
-    add_referral_history(referal, 'referral', db)
+    await db.commit()
+    await db.refresh(referal)
     return link
 
 
 # client
-async def get_tasks_top(db: _orm.Session):
-    top = dict()
-    tasks = db.query(models.ClientInWork).filter(models.ClientInWork.status == 'approved').all()
-    all_users = set()
-    unmarked_top = []
-    for task in tasks:
-        try:
-            top[task.worker_id] += 1
-        except KeyError:
-            top[task.worker_id] = 1
-        all_users.add(task.worker_id)
-    for user in all_users:
-        user_model = db.query(models.User).get(user)
-        unmarked_top.append(
-            {'username': user_model.username, 'closes': top[user_model.id], 'balance': user_model.balance})
-    unmarked_top.sort(key=lambda x: x['closes'])
-    unmarked_top.reverse()
-    return unmarked_top
+async def get_tasks_top(db: _asyncio.AsyncSession, limit: int = None):
+    return await leaderboard.top(db, limit)
+
+
+async def get_tasks_top_rank(user: models.User, db: _asyncio.AsyncSession):
+    return await leaderboard.rank(user.id, db)
 
 
-def get_user_state(user: models.User, db: _orm.Session):
-    return db.query(models.User).filter(models.User.id == user.id).first().access
+async def get_user_state(user: models.User, db: _asyncio.AsyncSession):
+    return (await db.get(models.User, user.id)).access
 
 
-def get_regulation(db: _orm.Session):
-    return db.query(models.Regulation).all()
+async def get_regulation(page: pagination.Page, db: _asyncio.AsyncSession):
+    return await pagination.paginate(_sql.select(models.Regulation), page, models.Regulation.id, db)
 
 
-def get_study_material(db: _orm.Session):
-    return db.query(models.StudyMaterial).all()
+async def get_study_material(page: pagination.Page, db: _asyncio.AsyncSession):
+    return await pagination.paginate(_sql.select(models.StudyMaterial), page, models.StudyMaterial.id, db)
 
 
-async def add_client(client: schemas.ClientAdd, user: models.User, db: _orm.Session):
-    new_client = models.ClientInWork(name=client.name, phone_number=client.phone_number,
-                                     city=client.city, start_time=client.start_time,
-                                     from_who=client.from_who, call=client.call,
-                                     link=client.link, worker_id=user.id, manager_id=client.manager_id)
-    db.add(new_client)
-    db.commit()
-    db.refresh(new_client)
-    add_client_history(new_client, 'client', db)
+async def add_client(client: schemas.ClientAdd, user: models.User, db: _asyncio.AsyncSession):
+    async def stage(session: _asyncio.AsyncSession):
+        session.add(models.ClientInWork(name=client.name, phone_number=client.phone_number,
+                                        city=client.city, start_time=client.start_time,
+                                        from_who=client.from_who, call=client.call,
+                                        link=client.link, worker_id=user.id, manager_id=client.manager_id))
+
+    await write_queue.write(stage, db)
     return {'msg': 'ok'}
 
 
-async def add_client_comment(comment: schemas.ClientComment, db: _orm.Session):
-    client = db.query(models.ClientInWork).filter(models.ClientInWork.id == comment.id).first()
+async def add_client_comment(comment: schemas.ClientComment, db: _asyncio.AsyncSession):
+    client = await db.scalar(_sql.select(models.ClientInWork).where(models.ClientInWork.id == comment.id).limit(1))
     client.comment = comment.comment
-    db.commit()
-    add_client_history(client, 'client', db)
+    await db.commit()
     return {'msg': 'ok'}
 
 
-async def recruiter_team(user: models.User, db: _orm.Session):
-    users = db.query(models.User).filter(models.User.recruiter_id == user.id).all()
-    team = []
-    for worker in users:
-        closes = db.query(models.ClientInWork).filter(models.ClientInWork.worker_id == worker.id).filter(
-            models.ClientInWork.status == 'approved').all()
-        team.append({'username': worker.username, 'closes': len(closes), 'balance': worker.balance})
-    return team
+async def _team(member_filter, order_by, limit: int, offset: int, db: _asyncio.AsyncSession):
+    closes = _sql.func.count(models.ClientInWork.id).label('closes')
+    stmt = _sql.select(models.User.username, closes, models.User.balance).outerjoin(
+        models.ClientInWork, _sql.and_(models.ClientInWork.worker_id == models.User.id,
+                                       models.ClientInWork.status == 'approved')).where(
+        member_filter).group_by(models.User.id).order_by(*order_by).offset(offset)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return [{'username': row.username, 'closes': row.closes, 'balance': row.balance}
+            for row in await db.execute(stmt)]
 
 
-async def recruiter_team_info(user: models.User, db: _orm.Session):
-    users = db.query(models.User).filter(models.User.recruiter_id == user.id).all()
-    ref_link = db.query(models.ReferralCode).filter(models.ReferralCode.username_id == user.id).first()
-    shared_balance, amount = 0, 0
-    for worker in users:
-        amount += 1
-        shared_balance += worker.balance
-    return {'balance': shared_balance, 'amount': amount, 'ref_link': ref_link.code}
-
-
-async def get_manager_team(user: models.User, db: _orm.Session):
-    users = db.query(models.User).filter(models.User.manager_id == user.id).all()
-    team = []
-    for worker in users:
-        closes = db.query(models.ClientInWork).filter(models.ClientInWork.worker_id == worker.id).filter(
-            models.ClientInWork.status == 'approved').all()
-        team.append({'username': worker.username, 'closes': len(closes), 'balance': worker.balance})
-    team.sort(key=lambda x: x['closes'])
-    team.reverse()
-    return team
+async def recruiter_team(user: models.User, db: _asyncio.AsyncSession, limit: int = None, offset: int = 0):
+    return await _team(models.User.recruiter_id == user.id, [models.User.id], limit, offset, db)
+
+
+async def recruiter_team_info(user: models.User, db: _asyncio.AsyncSession):
+    ref_link = _sql.select(models.ReferralCode.code).where(
+        models.ReferralCode.username_id == user.id).limit(1).scalar_subquery()
+    row = (await db.execute(_sql.select(_sql.func.count(models.User.id).label('amount'),
+                                        _sql.func.coalesce(_sql.func.sum(models.User.balance), 0).label('balance'),
+                                        ref_link.label('ref_link')).where(
+        models.User.recruiter_id == user.id))).one()
+    return {'balance': row.balance, 'amount': row.amount, 'ref_link': row.ref_link}
+
+
+async def get_manager_team(user: models.User, db: _asyncio.AsyncSession, limit: int = None, offset: int = 0):
+    return await _team(models.User.manager_id == user.id, [_sql.desc('closes'), models.User.id], limit, offset, db)
 
 
-def add_worker_manager(manager_add: schemas.AddManager, user: models.User, db: _orm.Session):
+async def add_worker_manager(manager_add: schemas.AddManager, user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'mentor':
-        worker = db.query(models.User).get(manager_add.worker_id)
+        worker = await db.get(models.User, manager_add.worker_id)
         worker.manager_id = manager_add.manager_id
-        db.commit()
+        await db.commit()
+        identity_cache.invalidate(worker.id)
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Вы не можете закрепить менеджера'})
 
 
-async def send_chat_message(ticket: int, text: str, user_id: int, db: _orm.Session):
-    message = models.ChatMessage(ticket_id=ticket, datetime=datetime.datetime.now(), message_text=text, user_id=user_id)
-    db.add(message)
-    db.commit()
-    db.refresh(message)
-    return {'msg': 'ok'}
+async def send_chat_message(ticket: int, text: str, user_id: int, db: _asyncio.AsyncSession):
+    async def stage(session: _asyncio.AsyncSession):
+        # the socket was let in on a cached ticket, which may have been closed since; the insert itself checks
+        # that, so storing a message stays a single statement
+        now = datetime.datetime.now()
+        values = _sql.select(_sql.literal(ticket), _sql.literal(now, _sql.DateTime), _sql.literal(text, _sql.String),
+                             _sql.literal(user_id)).where(models.TicketChat.id == ticket).where(
+            models.TicketChat.closed == False)
+        message_id = await session.scalar(_sql.insert(models.ChatMessage).from_select(
+            ['ticket_id', 'datetime', 'message_text', 'user_id'], values).returning(models.ChatMessage.id))
+        if message_id is None:
+            raise fastapi.HTTPException(status_code=400, detail={'msg': 'Тикет закрыт'})
+        return models.ChatMessage(id=message_id, ticket_id=ticket, datetime=now, message_text=text, user_id=user_id)
+
+    return await write_queue.write(stage, db)
 
 
-async def add_ticket(mentor: int, user: models.User, db: _orm.Session):
+async def add_ticket(mentor: int, user: models.User, db: _asyncio.AsyncSession):
     ticket = models.TicketChat(mentor_id=mentor, user_id=user.id)
     db.add(ticket)
-    db.commit()
-    db.refresh(ticket)
-    add_ticket_history(ticket, 'ticket', db)
+    await db.commit()
+    await db.refresh(ticket)
     return ticket.id
 
 
-async def close_ticket(ticket: schemas.TicketClose, db: _orm.Session):
-    ticket_obj = db.query(models.TicketChat).get(ticket.id)
+async def close_ticket(ticket: schemas.TicketClose, db: _asyncio.AsyncSession):
+    ticket_obj = await db.get(models.TicketChat, ticket.id)
     ticket_obj.closed = True
-    db.commit()
-    add_ticket_history(ticket_obj, 'ticket', db)
+    await db.commit()
+    ticket_cache.invalidate(ticket_obj.token)
+    await message_bus.bus.publish(message_bus.TICKET_CLOSED_TOPIC, {'chat_token': ticket_obj.token})
     return {'msg': 'ok'}
 
 
-async def get_ticket_chat(ticket: int, db: _orm.Session):
-    chat = db.query(models.ChatMessage).filter(models.ChatMessage.ticket_id == ticket).all()
-    return chat
-
-
-def add_payment_check(check: schemas.PaymentCheck, user: models.User, db: _orm.Session):
-    check = models.PaymentCheck(username_id=user.id, payment_type=user.payment_type,
-                                payment_details=user.payment_details,
-                                value=check.value)
-    db.add(check)
-    db.commit()
-    db.refresh(check)
-    add_payment_history(check, 'payment', db)
+async def get_chat_ticket(token: str, db: _asyncio.AsyncSession):
+    ticket = ticket_cache.get(token)
+    if ticket is None:
+        row = (await db.execute(_sql.select(models.TicketChat.id, models.TicketChat.user_id,
+                                            models.TicketChat.mentor_id, models.TicketChat.closed).where(
+            models.TicketChat.token == token).limit(1))).first()
+        if row is None:
+            return None
+        ticket = TicketAuth(*row)
+        ticket_cache.set(token, ticket)
+    return ticket
+
+
+async def get_ticket_chat(ticket: int, page: pagination.Page, db: _asyncio.AsyncSession, descending: bool = False):
+    # archived messages always have lower ids than the ones still in the hot table
+    if descending:
+        messages = list((await db.scalars(pagination.apply(_sql.select(models.ChatMessage).where(
+            models.ChatMessage.ticket_id == ticket), page, models.ChatMessage.id, descending=True))).all())
+        if len(messages) <= page.limit:
+            archived = [message for message in reversed(await archive.read(models.ChatMessage, ticket, db))
+                        if page.after is None or message.id < page.after]
+            messages += archived[:page.limit + 1 - len(messages)]
+        return pagination.envelope(messages, page)
+    archived = [message for message in await archive.read(models.ChatMessage, ticket, db)
+                if page.after is None or message.id > page.after][:page.limit + 1]
+    if len(archived) > page.limit:
+        return pagination.envelope(archived, page)
+    hot_page = pagination.Page(page.after, page.limit - len(archived))
+    messages = (await db.scalars(pagination.apply(_sql.select(models.ChatMessage).where(
+        models.ChatMessage.ticket_id == ticket), hot_page, models.ChatMessage.id))).all()
+    return pagination.envelope(archived + list(messages), page)
+
+
+async def add_payment_check(check: schemas.PaymentCheck, user: models.User, db: _asyncio.AsyncSession):
+    async def stage(session: _asyncio.AsyncSession):
+        session.add(models.PaymentCheck(username_id=user.id, payment_type=user.payment_type,
+                                        payment_details=user.payment_details,
+                                        value=check.value))
+
+    await write_queue.write(stage, db)
     return {'msg': 'ok'}
 
 
-async def get_payment_mentor(user: models.User, db: _orm.Session):
+async def get_payment_mentor(user: models.User, page: pagination.Page, db: _asyncio.AsyncSession, state: str = None):
     if user.role == 'mentor':
-        users = db.query(models.User).filter(models.User.mentor_id == user.id).all()
+        pending = _sql.select(_sql.func.count(models.PaymentCheck.id).label('count'),
+                              _sql.func.coalesce(_sql.func.sum(models.PaymentCheck.value), 0).label('amount')).join(
+            models.User, models.User.id == models.PaymentCheck.username_id).where(
+            models.User.mentor_id == user.id).where(models.PaymentCheck.state == 'in_process').subquery()
+        stmt = _sql.select(models.PaymentCheck, models.User.username, pending.c.count, pending.c.amount).join(
+            models.User, models.User.id == models.PaymentCheck.username_id).join(pending, _sql.true()).where(
+            models.User.mentor_id == user.id)
+        if state is not None:
+            stmt = stmt.where(models.PaymentCheck.state == state)
+        rows = (await db.execute(pagination.apply(stmt, page, models.PaymentCheck.id, descending=True))).all()
+        if rows:
+            pending_count, pending_amount = rows[0].count, rows[0].amount
+        else:
+            pending_count, pending_amount = (await db.execute(_sql.select(pending))).one()
         payments = []
-        for worker in users:
-            payments_list = db.query(models.PaymentCheck).filter(models.PaymentCheck.username_id == worker.id).all()
-            for i in range(len(payments_list)):
-                setattr(payments_list[i], 'username', worker.username)
-            payments += payments_list
-        payments.sort(key=lambda x: x.id, reverse=True)
-        return payments
+        for check, username, _, _ in rows:
+            setattr(check, 'username', username)
+            payments.append(check)
+        return {**pagination.envelope(payments, page), 'pending_count': pending_count, 'pending_amount': pending_amount}
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'у вас нет доступа к данным'})
 
 
-def close_payment_mentor(payment: schemas.PaymentClose, user: models.User, db: _orm.Session):
+async def close_payment_mentor(payment: schemas.PaymentClose, user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'mentor':
-        check = db.query(models.PaymentCheck).get(payment.id)
+        check = await db.get(models.PaymentCheck, payment.id)
         check.state = payment.state
-        worker = db.query(models.User).get(check.username_id)
+        worker = await db.get(models.User, check.username_id)
         if check.state == 'approved':
             worker.balance -= check.value
-        db.commit()
-        add_payment_history(check, 'payment', db)
+        await db.commit()
+        identity_cache.invalidate(worker.id)
         return {'msg': 'ok'}
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Вы не можете редактировать чеки'})
 
 
-def accept_user(user_data: schemas.UserAccept, user: models.User, db: _orm.Session):
-    worker_user = db.query(models.User).get(user_data.id)
+async def accept_user(user_data: schemas.UserAccept, user: models.User, db: _asyncio.AsyncSession):
+    worker_user = await db.get(models.User, user_data.id)
     if user.role == 'mentor':
         if user_data.access == 'rejected':
-            db.delete(worker_user)
-            db.commit()
+            await db.delete(worker_user)
+            await db.commit()
+            identity_cache.invalidate(user_data.id)
             return {'msg': "ok"}
         worker_user.access = user_data.access
-        db.commit()
-        add_user_history(worker_user, 'user', db)
+        await db.commit()
+        identity_cache.invalidate(worker_user.id)
         return {'msg': 'ok'}
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Вы не можете принимать пользователей'})
 
 
-async def get_mentor_users(user: models.User, db: _orm.Session):
-    users = db.query(models.User).filter(models.User.mentor_id == user.id).all()
-    users.sort(key=lambda x:x.id)
-    users.reverse()
-    return users
+async def get_mentor_users(user: models.User, page: pagination.Page, db: _asyncio.AsyncSession):
+    return await pagination.paginate(_sql.select(models.User).where(models.User.mentor_id == user.id),
+                                     page, models.User.id, db, descending=True)
 
 
-async def get_mentor_ticket(user: models.User, db: _orm.Session):
+async def get_mentor_ticket(user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'mentor':
-        tickets = db.query(models.TicketChat).filter(models.TicketChat.mentor_id == user.id).filter(
-            models.TicketChat.closed == False).all()
+        tickets = (await db.scalars(_sql.select(models.TicketChat).where(models.TicketChat.mentor_id == user.id).where(
+            models.TicketChat.closed == False))).all()
         for i in range(len(tickets)):
-            setattr(tickets[i], 'username', db.query(models.User).get(tickets[i].user_id).username)
+            setattr(tickets[i], 'username', (await db.get(models.User, tickets[i].user_id)).username)
         return tickets
     raise fastapi.HTTPException(status_code=400, detail={'msg': 'Нет доступа к данным'})
 
 
-async def get_worker_ticket(user: models.User, db: _orm.Session):
-    tickets = db.query(models.TicketChat).filter(models.TicketChat.user_id == user.id).filter(
-        models.TicketChat.closed == False).all()
+async def get_worker_ticket(user: models.User, db: _asyncio.AsyncSession):
+    tickets = (await db.scalars(_sql.select(models.TicketChat).where(models.TicketChat.user_id == user.id).where(
+        models.TicketChat.closed == False))).all()
     return tickets
 
 
-async def accept_manager_client(client: schemas.AcceptClient, user: models.User, db: _orm.Session):
+async def accept_manager_client(client: schemas.AcceptClient, user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'manager':
-        client_obj = db.query(models.ClientInWork).get(client.id)
+        client_obj = await db.get(models.ClientInWork, client.id)
+        await leaderboard.apply_status_change(client_obj.worker_id, client_obj.status, client.status, db)
         client_obj.status = client.status
-        worker = db.query(models.User).get(client_obj.worker_id)
+        worker = await db.get(models.User, client_obj.worker_id)
         if client.status == 'approved':
-            reward = db.query(models.ClientReward).first()
+            reward = await db.scalar(_sql.select(models.ClientReward).limit(1))
             worker.balance += reward.number_reward
-        db.commit()
+        await db.commit()
+        identity_cache.invalidate(worker.id)
         return {'msg': 'ok'}
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Вы не можете редактировать клиентов'})
 
 
-async def add_mentor_task(task: schemas.MentorTask, user: models.User, db: _orm.Session):
+async def add_mentor_task(task: schemas.MentorTask, user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'mentor':
         new_task = models.Task(aim=task.aim, username=task.username, award=task.award, mentor_id=user.id,
                                category=task.category)
         db.add(new_task)
-        db.commit()
-        db.refresh(new_task)
+        await db.commit()
+        await db.refresh(new_task)
+        feed_generation[new_task.category] += 1
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Вы не можете добавлять клиентов'})
 
 
-async def get_new_tasks(user: models.User, db: _orm.Session):
-    tasks = db.query(models.Task).filter(models.Task.mentor_id == user.id).all()
-    tasks_id = [x.id for x in tasks]
-    requests_tasks = db.query(models.TaskRequest).filter(models.TaskRequest.task_id.in_(tasks_id)).all()
-    requests_id = [x.task_id for x in requests_tasks]
-    new_tasks = []
-    for task in tasks:
-        if task.id not in requests_id:
-            new_tasks.append(task)
-    return new_tasks
-
-
-async def get_active_tasks(user: models.User, db: _orm.Session):
-    tasks = db.query(models.Task).filter(models.Task.mentor_id == user.id).all()
-    tasks_id = [x.id for x in tasks]
-    active_tasks = db.query(models.TaskRequest).filter(models.TaskRequest.task_id.in_(tasks_id)).filter(
-        models.TaskRequest.status.in_(['active', 'refused'])).all()
-    for task in range(len(active_tasks)):
-        task_data = list(filter(lambda x: x.id == active_tasks[task].task_id, tasks))[0]
-        setattr(active_tasks[task], 'aim', task_data.aim)
-        setattr(active_tasks[task], 'award', task_data.award)
-        setattr(active_tasks[task], 'username', task_data.username)
-        setattr(active_tasks[task], 'category', task_data.category)
-    return active_tasks
-
-
-async def get_finished_tasks(user: models.User, db: _orm.Session):
-    tasks = db.query(models.Task).filter(models.Task.mentor_id == user.id).all()
-    tasks_id = [x.id for x in tasks]
-    finished_tasks = db.query(models.TaskRequest).filter(models.TaskRequest.task_id.in_(tasks_id)).filter(
-        models.TaskRequest.status.in_(['finished', 'approved', 'rejected'])).all()
-    for task in range(len(finished_tasks)):
-        task_data = list(filter(lambda x: x.id == finished_tasks[task].task_id, tasks))[0]
-        setattr(finished_tasks[task], 'aim', task_data.aim)
-        setattr(finished_tasks[task], 'award', task_data.award)
-        setattr(finished_tasks[task], 'username', task_data.username)
-        setattr(finished_tasks[task], 'category', task_data.category)
-    return finished_tasks
-
-
-async def get_tasks_request(user: models.User, db: _orm.Session):
-    tasks = db.query(models.Task).filter(models.Task.mentor_id == user.id).all()
+async def get_new_tasks(user: models.User, db: _asyncio.AsyncSession):
+    requested = _sql.exists().where(models.TaskRequest.task_id == models.Task.id)
+    return (await db.scalars(_sql.select(models.Task).where(models.Task.mentor_id == user.id).where(
+        ~requested).order_by(models.Task.id))).all()
+
+
+async def _mentor_task_requests(user: models.User, statuses: list, db: _asyncio.AsyncSession):
+    stmt = _sql.select(models.TaskRequest.id, models.TaskRequest.task_id, models.TaskRequest.user_id,
+                       models.TaskRequest.status, models.TaskRequest.comment, models.TaskRequest.date,
+                       models.Task.aim, models.Task.award, models.Task.username, models.Task.category).join(
+        models.Task, models.Task.id == models.TaskRequest.task_id).where(models.Task.mentor_id == user.id).where(
+        models.TaskRequest.status.in_(statuses)).order_by(models.TaskRequest.id)
+    return [dict(row._mapping) for row in await db.execute(stmt)]
+
+
+async def get_active_tasks(user: models.User, db: _asyncio.AsyncSession):
+    return await _mentor_task_requests(user, ['active', 'refused'], db)
+
+
+async def get_finished_tasks(user: models.User, db: _asyncio.AsyncSession):
+    return await _mentor_task_requests(user, ['finished', 'approved', 'rejected'], db)
+
+
+async def get_tasks_request(user: models.User, db: _asyncio.AsyncSession):
+    tasks = (await db.scalars(_sql.select(models.Task).where(models.Task.mentor_id == user.id))).all()
     ids = [task.id for task in tasks]
-    task_requests = db.query(models.TaskRequest).filter(models.TaskRequest.task_id.in_(ids)).all()
+    task_requests = (await db.scalars(_sql.select(models.TaskRequest).where(models.TaskRequest.task_id.in_(ids)))).all()
     task_requests.sort(key=lambda x: x.id, reverse=True)
     return task_requests
 
 
-async def edit_mentor_tasks(task: schemas.MentorTaskEdit, user: models.User, db: _orm.Session):
+async def edit_mentor_tasks(task: schemas.MentorTaskEdit, user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'mentor':
-        task_obj = db.query(models.Task).get(task.task_id)
+        task_obj = await db.get(models.Task, task.task_id)
+        old_category = task_obj.category
         if task.aim != 0:
             setattr(task_obj, 'aim', task.aim)
         for item in ['award', 'username', 'category']:
             if getattr(task_obj, item) != '':
                 setattr(task_obj, item, getattr(task, item))
-        db.commit()
+        await db.commit()
+        feed_generation[old_category] += 1
+        feed_generation[task_obj.category] += 1
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Вы не можете редактировать задания'})
 
 
-async def submit_task_request(task: schemas.MentorTaskSubmit, user: models.User, db: _orm.Session):
+async def submit_task_request(task: schemas.MentorTaskSubmit, user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'mentor':
-        task_obj = db.query(models.TaskRequest).get(task.request_id)
-        task_model = db.query(models.Task).get(task_obj.task_id)
+        task_obj = await db.get(models.TaskRequest, task.request_id)
+        task_model = await db.get(models.Task, task_obj.task_id)
         setattr(task_obj, 'status', task.status)
         setattr(task_obj, 'comment', task.comment)
         if task.status == 'approved':
-            user_obj = db.query(models.User).get(task_obj.user_id)
+            user_obj = await db.get(models.User, task_obj.user_id)
             user_obj.balance += task_model.award
-        db.commit()
+        await db.commit()
+        identity_cache.invalidate(task_obj.user_id)
+        feed_cache.invalidate(task_obj.user_id)
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Вы не можете подтверждать клиентов'})
 
 
-def task_state(tasks: list, task_id: int):
-    for i in range(len(tasks)):
-        if tasks[i].id == task_id:
-            return i
-
-
-async def get_tasks_user(user: models.User, db: _orm.Session):
-    tasks_all = db.query(models.Task).filter(models.Task.category == user.role).all()
-    tasks_user = db.query(models.Task).filter(models.Task.category == 'one_user').filter(
-        models.Task.username == user.username).all()
-    all_tasks = tasks_user + tasks_all
-    for task in range(len(all_tasks)):
-        setattr(all_tasks[task], 'status', 'waiting')
-    user_requests = db.query(models.TaskRequest).filter(models.TaskRequest.user_id == user.id).all()
-    for req in user_requests:
-        task_id = task_state(all_tasks, req.task_id)
-        setattr(all_tasks[task_id], 'status', req.status)
-    return all_tasks
+async def get_tasks_user(user: models.User, db: _asyncio.AsyncSession):
+    version = (user.role, user.username, feed_generation[user.role], feed_generation['one_user'])
+    cached = feed_cache.get(user.id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    # the user's latest request for each task, a task may have been taken more than once
+    taken = _orm.aliased(models.TaskRequest)
+    latest_request = _sql.select(_sql.func.max(taken.id)).where(taken.task_id == models.Task.id).where(
+        taken.user_id == user.id).correlate(models.Task).scalar_subquery()
+    one_user = models.Task.category == 'one_user'
+    stmt = _sql.select(*models.Task.__table__.columns,
+                       _sql.func.coalesce(models.TaskRequest.status, 'waiting').label('status')).outerjoin(
+        models.TaskRequest, models.TaskRequest.id == latest_request).where(
+        _sql.or_(models.Task.category == user.role, _sql.and_(one_user, models.Task.username == user.username))).order_by(
+        one_user.desc(), models.Task.id)
+    tasks = [dict(row._mapping) for row in await db.execute(stmt)]
+    feed_cache.set(user.id, (version, tasks))
+    return tasks
 
 
-async def send_task_request(task: schemas.MissionSubmit, user: models.User, db: _orm.Session):
+async def send_task_request(task: schemas.MissionSubmit, user: models.User, db: _asyncio.AsyncSession):
     task_obj = models.TaskRequest(user_id=user.id, task_id=task.task_id, status=task.status)
     db.add(task_obj)
-    db.commit()
-    db.refresh(task_obj)
+    await db.commit()
+    await db.refresh(task_obj)
+    feed_cache.invalidate(user.id)
 
 
-async def send_task_submit(task: schemas.MissionSubmit, db: _orm.Session):
-    mission = db.query(models.TaskRequest).get(task.task_id)
+async def send_task_submit(task: schemas.MissionSubmit, db: _asyncio.AsyncSession):
+    mission = await db.get(models.TaskRequest, task.task_id)
     mission.status = 'finished'
-    db.commit()
+    await db.commit()
+    feed_cache.invalidate(mission.user_id)
 
 
-async def get_user_mentor(user: models.User, db: _orm.Session):
-    user_mentor = db.query(models.User).get(user.mentor_id)
+async def get_user_mentor(user: models.User, db: _asyncio.AsyncSession):
+    user_mentor = await db.get(models.User, user.mentor_id)
     return schemas.User.from_orm(user_mentor)
 
 
-def manager_username(managers: list, manager_id: int):
-    for i in range(len(managers)):
-        if managers[i].id == manager_id:
-            return managers[i].username
-
-
-async def get_mentor_clients(user: models.User, db: _orm.Session):
+async def get_mentor_clients(user: models.User, page: pagination.Page, db: _asyncio.AsyncSession,
+                             status: str = None, worker_id: int = None, manager_id: int = None,
+                             date_from: datetime.datetime = None, date_to: datetime.datetime = None):
     if user.role == 'mentor':
-        workers = db.query(models.User).filter(models.User.mentor_id == user.id).all()
-        managers = db.query(models.User).filter(models.User.role == 'manager').all()
-        clients = []
-        for worker in workers:
-            new_clients = db.query(models.ClientInWork).filter(models.ClientInWork.worker_id == worker.id).all()
-            clients += new_clients
-        for i in range(len(clients)):
-            manager_name = manager_username(managers, clients[i].manager_id)
-            setattr(clients[i], 'manager_name', manager_name)
-        clients.sort(key=lambda x: x.id)
-        clients.reverse()
-        return clients
+        stmt = _sql.select(models.ClientInWork).join(models.User, models.User.id == models.ClientInWork.worker_id).where(
+            models.User.mentor_id == user.id)
+        if status is not None:
+            stmt = stmt.where(models.ClientInWork.status == status)
+        if worker_id is not None:
+            stmt = stmt.where(models.ClientInWork.worker_id == worker_id)
+        if manager_id is not None:
+            stmt = stmt.where(models.ClientInWork.manager_id == manager_id)
+        if date_from is not None:
+            stmt = stmt.where(models.ClientInWork.start_time >= date_from)
+        if date_to is not None:
+            stmt = stmt.where(models.ClientInWork.start_time < date_to)
+        return await _clients_with_manager(stmt, page, db, descending=True)
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Нет доступа к данным'})
 
 
-async def add_manager_deposit(deposit: schemas.AddDeposit, user: models.User, db: _orm.Session):
+async def add_manager_deposit(deposit: schemas.AddDeposit, user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'manager':
-        client = db.query(models.ClientInWork).get(deposit.client_id)
-        reward = db.query(models.ClientReward).first()
+        client = await db.get(models.ClientInWork, deposit.client_id)
+        reward = await db.scalar(_sql.select(models.ClientReward).limit(1))
         first_day = datetime.datetime.now().replace(day=1)
-        all_clients = db.query(models.ClientInWork).filter(models.ClientInWork.worker_id == client.worker_id).filter(
-            models.ClientInWork.deposit_date >= first_day).all()
+        all_clients = (await db.scalars(_sql.select(models.ClientInWork).where(
+            models.ClientInWork.worker_id == client.worker_id).where(
+            models.ClientInWork.deposit_date >= first_day))).all()
         dep_num = len(all_clients)
         client.deposit = True
-        worker = db.query(models.User).get(client.worker_id)
+        worker = await db.get(models.User, client.worker_id)
         if dep_num < 3:
             exec(f'worker.balance += reward.deposit_reward_{dep_num + 1}')
         else:
             worker.balance += reward.deposit_reward_3
-        db.commit()
+        await db.commit()
+        identity_cache.invalidate(worker.id)
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Вы не можете редактировать клиента'})
 
 
-async def add_manager_call(call: schemas.AddCall, user: models.User, db: _orm.Session):
+async def add_manager_call(call: schemas.AddCall, user: models.User, db: _asyncio.AsyncSession):
     if user.role == 'manager':
-        client = db.query(models.ClientInWork).get(call.client_id)
-        reward = db.query(models.ClientReward).first()
-        worker = db.query(models.User).get(client.worker_id)
+        client = await db.get(models.ClientInWork, call.client_id)
+        reward = await db.scalar(_sql.select(models.ClientReward).limit(1))
+        worker = await db.get(models.User, client.worker_id)
         worker.balance += reward.call_reward
         client.checked_number = True
-        db.commit()
+        await db.commit()
+        identity_cache.invalidate(worker.id)
     else:
         raise fastapi.HTTPException(status_code=400, detail={'msg': 'Вы не можете редактировать клиента'})
+
+
+# history entity -> column naming the worker it belongs to
+HISTORY_OWNER = {'user': 'id', 'client': 'worker_id', 'ticket': 'user_id', 'payment': 'username_id'}
+
+
+async def _state_as_of(history_model, entity_id: int, at: datetime.datetime, db: _asyncio.AsyncSession):
+    rows = (await db.scalars(history.as_of_statement(history_model, entity_id, at))).all()
+    if not rows:
+        rows = history.chain_as_of(await archive.read(history_model, entity_id, db), at)
+    return history.state_of(rows) if rows else None
+
+
+async def _in_mentor_team(mentor_id: int, user_id: int, at: datetime.datetime, db: _asyncio.AsyncSession):
+    # in the team now or at the time asked about
+    if user_id is None:
+        return False
+    if await db.scalar(_sql.select(models.User.mentor_id).where(models.User.id == user_id)) == mentor_id:
+        return True
+    state = await _state_as_of(models.UserHistory, user_id, at, db)
+    return state is not None and state.get('mentor_id') == mentor_id
+
+
+async def get_history_as_of(entity: str, entity_id: int, at: datetime.datetime, user: models.User,
+                            db: _asyncio.AsyncSession):
+    if user.role not in ('mentor', 'admin'):
+        raise fastapi.HTTPException(status_code=400, detail={'msg': 'Нет доступа к данным'})
+    if entity not in history.ENTITIES:
+        raise fastapi.HTTPException(status_code=400, detail={'msg': 'Неизвестный тип записи'})
+    state = await _state_as_of(history.ENTITIES[entity], entity_id, at, db)
+    if state is None:
+        raise fastapi.HTTPException(status_code=404, detail={'msg': 'Нет данных на указанную дату'})
+    if user.role == 'mentor':
+        own = (entity == 'user' and state['id'] == user.id) or (entity == 'ticket' and state.get('mentor_id') == user.id)
+        if not own and not await _in_mentor_team(user.id, state.get(HISTORY_OWNER[entity]), at, db):
+            raise fastapi.HTTPException(status_code=400, detail={'msg': 'Нет доступа к данным'})
+    return state
+
+
+async def get_mentor_team_as_of(at: datetime.datetime, user: models.User, db: _asyncio.AsyncSession,
+                                mentor_id: int = None):
+    if user.role == 'mentor':
+        mentor_id = user.id
+    elif user.role != 'admin' or mentor_id is None:
+        raise fastapi.HTTPException(status_code=400, detail={'msg': 'Нет доступа к данным'})
+    user_id, version = models.UserHistory.user_id, models.UserHistory.version
+    # delta rows only carry mentor_id when it changed, so the value in force is the one from the last row
+    # that set it; the hot part of a chain starts with a checkpoint, so that row is hot whenever any row is
+    mentor_set = _sql.select(user_id.label('user_id'), _sql.func.max(version).label('version')).where(
+        models.UserHistory.change_time <= at).where(_sql.or_(
+            models.UserHistory.checkpoint == True,
+            (',' + models.UserHistory.changed_columns + ',').contains(',mentor_id,'))).group_by(user_id).subquery()
+    candidates = _sql.select(user_id).join(
+        mentor_set, _sql.and_(mentor_set.c.user_id == user_id, mentor_set.c.version == version)).where(
+        models.UserHistory.mentor_id == mentor_id)
+    rows = (await db.scalars(history.bulk_as_of_statement(models.UserHistory, candidates, at))).all()
+    states = history.reconstruct_many(rows)
+    # users whose hot rows all come later have their state at that time in the archive
+    archived = _sql.select(models.ArchiveBlock.key).where(models.ArchiveBlock.kind == models.UserHistory.__tablename__)
+    archived_users = (await db.scalars(_sql.select(user_id).where(user_id.in_(archived)).group_by(user_id).having(
+        _sql.func.min(models.UserHistory.change_time) > at))).all()
+    for start in range(0, len(archived_users), archive.BATCH_SIZE):
+        chunk = archived_users[start:start + archive.BATCH_SIZE]
+        for archived_id, rows in (await archive.read_many(models.UserHistory, chunk, db)).items():
+            chain = history.chain_as_of(rows, at)
+            if chain:
+                states[archived_id] = history.state_of(chain)
+    team = [state for state in states.values() if state.get('mentor_id') == mentor_id]
+    team.sort(key=lambda state: state['id'])
+    return team
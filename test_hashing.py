@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import time
+
+import fastapi
+import pytest
+from passlib.context import CryptContext
+
+import hashing
+
+
+def test_full_queue_is_rejected_with_503():
+    release = threading.Event()
+
+    def blocked(value):
+        release.wait(5)
+        return value
+
+    async def scenario():
+        pool = hashing.HashingPool(workers=1, max_queued=2)
+        running = asyncio.ensure_future(pool.run(blocked, 'running'))
+        while pool.stats()['running'] < 1:
+            await asyncio.sleep(0.001)
+        queued = [asyncio.ensure_future(pool.run(blocked, f'queued {number}')) for number in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(fastapi.HTTPException) as rejected:
+            await pool.run(blocked, 'rejected')
+        full = pool.stats()
+        release.set()
+        results = await asyncio.gather(running, *queued)
+        return rejected.value, full, results, pool.stats()
+
+    rejected, full, results, done = asyncio.run(scenario())
+    assert rejected.status_code == 503
+    assert full['queued'] == 2 and full['running'] == 1 and full['max_queued'] == 2 and full['rejected'] == 1
+    assert results == ['running', 'queued 0', 'queued 1']
+    assert done['queued'] == 0 and done['running'] == 0 and done['completed'] == 3 and done['rejected'] == 1
+
+
+def test_event_loop_stays_responsive_during_login_burst():
+    # a burst of logins: the hashing runs on the pool threads while the loop keeps serving other work
+    context = CryptContext(schemes=['bcrypt'], bcrypt__default_rounds=8)
+    stored = context.hash('password')
+
+    async def scenario():
+        pool = hashing.HashingPool(workers=2, max_queued=64)
+        lags = []
+        stop = asyncio.Event()
+
+        async def ticker():
+            while not stop.is_set():
+                started = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lags.append(time.perf_counter() - started - 0.005)
+
+        ticking = asyncio.ensure_future(ticker())
+        results = await asyncio.gather(*(pool.run(context.verify, 'password', stored) for _ in range(40)))
+        stop.set()
+        await ticking
+        return results, lags, pool.stats()
+
+    results, lags, stats = asyncio.run(scenario())
+    assert all(results)
+    assert stats['completed'] == 40 and stats['rejected'] == 0 and stats['max_queued'] <= 40
+    assert max(lags) < 0.05
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
+
+import write_queue
+
+metadata = _sql.MetaData()
+note = _sql.Table('note', metadata, _sql.Column('id', _sql.Integer, primary_key=True), _sql.Column('text', _sql.String))
+
+
+async def _coordinator():
+    engine = _asyncio.create_async_engine('sqlite+aiosqlite://')
+    async with engine.begin() as connection:
+        await connection.run_sync(metadata.create_all)
+    return engine, write_queue.WriteCoordinator(_asyncio.async_sessionmaker(engine), batch_size=64, batch_wait=0.05)
+
+
+def _insert(text: str):
+    async def stage(db):
+        await db.execute(_sql.insert(note).values(text=text))
+        return text
+    return stage
+
+
+def test_batch_commits_every_write():
+    async def scenario():
+        engine, coordinator = await _coordinator()
+        results = await asyncio.gather(*(coordinator.submit(_insert(f'n{number}')) for number in range(5)))
+        await coordinator.close()
+        async with engine.connect() as connection:
+            stored = (await connection.scalars(_sql.select(note.c.text).order_by(note.c.id))).all()
+        await engine.dispose()
+        return results, stored, coordinator.batches
+
+    results, stored, batches = asyncio.run(scenario())
+    assert results == stored == [f'n{number}' for number in range(5)]
+    assert batches == 1
+
+
+def test_cancelled_caller_inside_failing_batch():
+    async def scenario():
+        engine, coordinator = await _coordinator()
+        callers = {}
+
+        async def cancel_and_fail(db):
+            # the caller goes away while its write is being applied, and the write fails on replay as well
+            callers['cancelled'].cancel()
+            raise ValueError('cancelled write')
+
+        async def fail(db):
+            raise ValueError('failed write')
+
+        loop = asyncio.get_running_loop()
+        callers['ok'] = loop.create_task(coordinator.submit(_insert('kept')))
+        callers['cancelled'] = loop.create_task(coordinator.submit(cancel_and_fail))
+        callers['failed'] = loop.create_task(coordinator.submit(fail))
+        callers['after'] = loop.create_task(coordinator.submit(_insert('also kept')))
+        await asyncio.wait(callers.values())
+        await coordinator.close()
+        async with engine.connect() as connection:
+            stored = (await connection.scalars(_sql.select(note.c.text).order_by(note.c.id))).all()
+        await engine.dispose()
+        return callers, stored, coordinator.batches
+
+    callers, stored, batches = asyncio.run(scenario())
+    assert callers['ok'].result() == 'kept'
+    assert callers['after'].result() == 'also kept'
+    assert callers['cancelled'].cancelled()
+    with pytest.raises(ValueError, match='failed write'):
+        callers['failed'].result()
+    assert stored == ['kept', 'also kept']
+    assert batches == 1
@@ -0,0 +1,124 @@
+import asyncio
+import os
+
+import dotenv as _dotenv
+import sqlalchemy.ext.asyncio as _asyncio
+
+import database as _database
+
+_dotenv.load_dotenv()
+
+WRITE_COORDINATION = os.environ.get('WRITE_COORDINATION', 'false').lower() in ('1', 'true', 'yes')
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 64))
+# extra time a batch waits for more writes; at 0 it takes whatever queued up during the previous commit
+WRITE_BATCH_WAIT_MS = float(os.environ.get('WRITE_BATCH_WAIT_MS', 0))
+
+
+class WriteCoordinator:
+    # one writer task per process; submitted mutations are committed together in one transaction
+    def __init__(self, session_factory, batch_size: int, batch_wait: float):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = None
+        self._task = None
+        self.batches = 0
+        self.writes = 0
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, stage):
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((stage, future))
+        return await future
+
+    async def _collect(self):
+        # takes everything already queued, then waits for more until the batch is full or the budget is spent
+        batch = [await self._queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not None and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        deadline = asyncio.get_running_loop().time() + self.batch_wait
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            closing = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            try:
+                await self._commit(batch)
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            if closing:
+                return
+
+    async def _apply(self, batch: list, isolated: bool):
+        results = []
+        async with self.session_factory() as db:
+            for stage, future in batch:
+                if not isolated:
+                    results.append((future, await stage(db)))
+                    continue
+                try:
+                    async with db.begin_nested():
+                        results.append((future, await stage(db)))
+                except Exception as error:
+                    # the caller may have been cancelled while the batch was running
+                    if not future.done():
+                        future.set_exception(error)
+            await db.commit()
+        return results
+
+    async def _commit(self, batch: list):
+        batch = [(stage, future) for stage, future in batch if not future.done()]
+        if not batch:
+            return
+        try:
+            results = await self._apply(batch, isolated=False)
+        except Exception:
+            # something in the batch failed: replay it with a savepoint per write so the others still commit
+            results = await self._apply(batch, isolated=True)
+        self.batches += 1
+        self.writes += len(results)
+        for future, result in results:
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        # writes queued before close are still committed
+        if self._task is not None and not self._task.done():
+            await self._queue.put(None)
+            await self._task
+        self._task = None
+
+    def stats(self):
+        return {'batches': self.batches, 'writes': self.writes,
+                'queued': self._queue.qsize() if self._queue is not None else 0}
+
+
+coordinator = WriteCoordinator(_database.AsyncSessionLocal, WRITE_BATCH_SIZE,
+                               WRITE_BATCH_WAIT_MS / 1000) if WRITE_COORDINATION else None
+
+
+async def write(stage, db: _asyncio.AsyncSession):
+    # stage(session) adds its changes without committing and may be replayed, so it must not have side effects
+    # outside the session; its result is returned once the changes are committed
+    if coordinator is None:
+        result = await stage(db)
+        await db.commit()
+        return result
+    return await coordinator.submit(stage)